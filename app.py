@@ -1,10 +1,23 @@
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.dependencies import Input, Output, State, ClientsideFunction, ALL, MATCH
+import numpy as np
 import pandas as pd
 import locale
 import data_processing
+import data_fetch
+import data_manager
+import figure_cache
+import downsampling
+import figure_encoding
+import metrics
+import region_search
+import derived_series
+import regions as region_table
+import os
+import hashlib
 import json
 
 locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
@@ -19,7 +32,9 @@ app = dash.Dash(
                          {"property":"og:image","content":"https://i.imgur.com/EJLqbKL.png"}, # og image needs absolute URL. I don't know a better way to do this
                          {"property":"og:image:height","content":"918"},
                          {"property":"og:image:width","content":"1880"}],
-    suppress_callback_exceptions=True, external_stylesheets=external_stylesheets
+    suppress_callback_exceptions=True, external_stylesheets=external_stylesheets,
+    # Compress responses with Flask-Compress
+    compress=True,
 )
 app.title = "COVID-19 Cases NZ"
 
@@ -69,32 +84,66 @@ dataSourceText = "Data sources: [Johns Hopkins](https://github.com/CSSEGISandDat
 
 default_country = "New Zealand"
 
+# Loaded once and refreshed in the background. Callbacks take a snapshot at the start so they see consistent data
+dataManager = data_manager.DataManager()
+# Start loading when the app is imported rather than on the first request. From the shared snapshot on disk this
+# takes milliseconds; without one the download starts while the server is still starting up.
+if os.environ.get("DATA_PRELOAD", "1") == "1":
+    dataManager.preload()
+
+# Turn the selected regions' data into figures in the browser, so changing scale or new/total needs no request
+clientsideViews = os.environ.get("CLIENTSIDE_VIEWS", "0") == "1"
+
+# Serve the page with the default view (the default country's total cases on a linear scale) and its header already
+# rendered, so the first chart is drawn without waiting for any callback. Each tab's content also comes with its
+# default figure.
+prerenderDefaultView = os.environ.get("PRERENDER_DEFAULT_VIEW", "1") == "1"
+defaultTab = "cases"
+
+# Finished figures for the most requested views. Keys include the data version, and the cache is emptied when new
+# data is loaded
+figureCache = figure_cache.FigureCache()
+dataManager.listeners.append(lambda snapshot: figureCache.clear())
+
+# Timing of every callback request, and the state of the data and caches, on /metrics
+metrics.instrumentServer(server, lambda output: getattr(app.callback_map.get(output, {}).get("callback"), "__name__",
+                                                        "unknown"))
+metrics.Gauge("data_snapshot_age_seconds", "Seconds since the data being served was loaded", dataManager.age)
+metrics.Gauge("data_last_refresh_duration_seconds", "Time taken by this worker's last data refresh",
+              lambda: dataManager.last_refresh_duration)
+metrics.Gauge("figure_cache_requests_total", "Figure cache lookups",
+              lambda: {(("result", "hit"),): figureCache.hits, (("result", "miss"),): figureCache.misses},
+              type="counter")
+metrics.Gauge("figure_cache_bytes", "Size of the cached figures", lambda: figureCache.stats()["bytes"])
+metrics.Gauge("data_fetch_total", "Upstream fetches by result (hits were unchanged upstream)",
+              lambda: {(("result", name),): count for name, count in data_fetch.snapshotStore.stats.items()},
+              type="counter")
 
-def createLayout():
-    global cases, casesText, casesNew, deaths, deathsText, deathsNew, population
 
-    cases, casesText, casesNew, deaths, deathsText, deathsNew, population = data_processing.getData()
+def createLayout():
+    # Make sure data is loaded before the first callbacks arrive
+    snapshot = dataManager.get()
+    header = createHeader(defaultTab, default_country, "total", snapshot) if prerenderDefaultView else None
+    content = tabContent(defaultTab, snapshot) if prerenderDefaultView else None
 
     return html.Div(
         id="mainContainer",
         className="mainContainer",
         children=[
-            html.Div(id="header_accumulator_cases", style={"display":"none"}),
-            html.Div(id="header_accumulator_deaths", style={"display":"none"}),
-
             # empty Div to trigger javascript file for autocomplete off
             html.Div(id="output-clientside"),
 
             html.Div(
                 className="flex-display",
                 children=[
-                    html.H3(id="header", style={"flex": "1", "marginTop": "0", "textAlign": "center"}),
+                    html.H3(id="header", style={"flex": "1", "marginTop": "0", "textAlign": "center"},
+                            children=header),
                 ],
             ),
 
             dcc.Tabs(
                 id='tab_selector',
-                value='cases',
+                value=defaultTab,
                 className="tab_container",
                 # Style needs to be here not in style.css or it doesn't work
                 style={"display": "flex", "flexFlow": "row nowrap"},
@@ -111,6 +160,7 @@ def createLayout():
                     "marginTop": "0"
                 },
                 # Tab content goes here
+                children=content,
             ),
             html.Div(
                 className="flex-display",
@@ -124,9 +174,126 @@ def createLayout():
 app.layout = createLayout
 
 
-@app.callback(Output('main_row', 'children'), [Input('tab_selector', 'value')])
+# Registers a callback that is replaced by a clientside one when clientsideViews is on
+def serverViewCallback(*args, **kwargs):
+    if clientsideViews:
+        return lambda func: func
+    return app.callback(*args, **kwargs)
+
+
+# Components in the tabs have pattern matching ids, {"type": ..., "tab": tab_value}. Dash requires all inputs of a
+# callback to exist at the time the callback is run, which isn't possible with a set of ids for each dynamically
+# generated tab. Matching every tab with ALL gives the callbacks a list holding the controls of the tab that is shown,
+# so one callback serves all tabs and the header without intermediate elements.
+def tabId(type, tab_value):
+    return {"type": type, "tab": tab_value}
+
+
+# The tab the callback was called for, from the id of its first input
+def shownTab():
+    return dash.callback_context.inputs_list[0][0]["id"]["tab"]
+
+
+# Graph titles, axis labels and header text for the cases and deaths tabs
+tabText = {
+    "cases": dict(
+        totalTitle="Total cases of COVID-19<br> over time",
+        newTitle="New cases of COVID-19<br> over time",
+        yLabel="Confirmed cases",
+        perCapitaYLabel="Confirmed cases per 10,000 population",
+        alignedTitle="Total cases of COVID-19<br> since the %s case",
+        alignedXLabel="Days since the %s case",
+        alignedControl="Days Since Case Number:",
+        alignedScale="Days since Nth case",
+        totalHeader="As of %s, there have been %d cases in total of COVID-19 in %s",
+        newHeader="On %s, there were %d new cases of COVID-19 in %s",
+    ),
+    "deaths": dict(
+        totalTitle="Deaths from COVID-19<br> over time",
+        newTitle="Change in deaths from COVID-19<br> over time",
+        yLabel="Deaths",
+        perCapitaYLabel="Deaths per 10,000 population",
+        alignedTitle="Deaths from COVID-19<br> since the %s death",
+        alignedXLabel="Days since the %s death",
+        alignedControl="Days Since Death Number:",
+        alignedScale="Days since Nth death",
+        totalHeader="As of %s, there have been %d deaths from COVID-19 in %s",
+        newHeader="On %s, there were %d new deaths from COVID-19 in %s ",
+    ),
+}
+
+
+# The aligned scale is named after what the tab counts
+def scaleOptions(tab_value):
+    return [
+        {'label': 'Linear', 'value': 'linear'},
+        {'label': 'Log', 'value': 'log'},
+        {'label': 'Per 10,000 population', 'value': 'per_capita'},
+        {'label': tabText[tab_value]["alignedScale"], 'value': 'aligned'},
+    ]
+
+
+# The aligned scale puts every region on a common axis of days since its total reached the threshold chosen from
+# derived_series.alignThresholds
+defaultAlignThreshold = 100
+
+
+def ordinal(n):
+    return "%d%s" % (n, "th" if 10 <= n % 100 < 20 else {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th"))
+
+
+def thresholdOptions():
+    return [{'label': ordinal(threshold), 'value': threshold} for threshold in derived_series.alignThresholds]
+
+
+# The threshold to align at, falling back to the default for one that isn't in the alignment index (a value
+# persisted in the browser before the thresholds changed)
+def alignThreshold(threshold):
+    return threshold if threshold in derived_series.alignThresholds else defaultAlignThreshold
+
+
+# Only the linear scale applies to new counts
+def createScaleOptions(tab_value, newvtotal_value):
+    return [dict(item, disabled=newvtotal_value == "new" and item["value"] != "linear")
+            for item in scaleOptions(tab_value)]
+
+
+# Region options and search index for the current snapshot
+regionIndexes = {}
+# Content of each tab for the current snapshot, so switching tabs doesn't rebuild the controls and options
+tabContents = {}
+dataManager.listeners.append(lambda snapshot: (regionIndexes.clear(), tabContents.clear()))
+
+
+def regionIndex(snapshot):
+    index = regionIndexes.get(snapshot.version)
+    if index is None:
+        # US counties can be searched for, and are listed under their state when it is selected, but aren't among
+        # the regions listed up front
+        index = regionIndexes[snapshot.version] = region_search.RegionIndex(
+            snapshot.regions.index, snapshot.cases.columns, region_table.childNames(snapshot.regions))
+    return index
+
+
+# The default tab's content is in the layout when the default view is prerendered
+@app.callback(Output('main_row', 'children'), [Input('tab_selector', 'value')],
+              prevent_initial_call=prerenderDefaultView)
 def create_tab_content(tab_value):
-    dropdown_columns = cases.columns
+    return tabContent(tab_value, dataManager.get())
+
+
+def tabContent(tab_value, snapshot):
+    content = tabContents.get((tab_value, snapshot.version))
+    if content is None:
+        content = tabContents[(tab_value, snapshot.version)] = createTabContent(tab_value, snapshot)
+    return content
+
+
+def createTabContent(tab_value, snapshot):
+    # With region search the dropdown starts with just the default selection, and loads the rest as the user types
+    dropdown_options = region_search.createOptions([default_country]) if region_search.regionSearch \
+        else regionIndex(snapshot).options
+    figure, store = defaultView(tab_value, snapshot)
 
     if tab_value == 'cases' or tab_value == 'deaths':
         return [
@@ -135,11 +302,12 @@ def create_tab_content(tab_value):
                 className="graph_container",
                 children=[
                     dcc.Graph(
-                        id=tab_value + '_graph',
+                        id=tabId('graph', tab_value),
                         className="graph",
                         config={
                             "displayModeBar": False,
                             "responsive": True},
+                        figure=figure,
                     )
                 ]
             ),
@@ -151,7 +319,7 @@ def create_tab_content(tab_value):
                 children=[
                     html.P("New or Total Cases:"),
                     dcc.RadioItems(
-                        id=tab_value + '_new_v_total',
+                        id=tabId('new_v_total', tab_value),
                         options=[
                             {'label': 'Total', 'value': 'total'},
                             {'label': 'New', 'value': 'new'},
@@ -162,32 +330,36 @@ def create_tab_content(tab_value):
                     html.P(""),
                     html.P("Graph Scale: "),
                     dcc.RadioItems(
-                        id=tab_value + '_scale',
-                        options=[
-                            {'label': 'Linear', 'value': 'linear'},
-                            {'label': 'Log', 'value': 'log'},
-                            {'label': 'Per 10,000 population', 'value': 'per_capita'},
-                        ],
+                        id=tabId('scale', tab_value),
+                        options=scaleOptions(tab_value),
                         value='linear',
                         persistence=True,
                     ),
                     html.P(""),
+                    html.P(tabText[tab_value]["alignedControl"]),
+                    dcc.RadioItems(
+                        id=tabId('threshold', tab_value),
+                        options=thresholdOptions(),
+                        value=defaultAlignThreshold,
+                        persistence=True,
+                    ),
+                    html.P(""),
                     html.P("Select Countries/States"),
                     html.Div(
                         className="button_container",
                         children=[
                             html.Button("Select All",
-                                        id=tab_value + '_select_all',
+                                        id=tabId('select_all', tab_value),
                                         style={"flex": "1", "margin": ".5rem"}
                                         ),
                             html.Button("Select None",
-                                        id=tab_value + '_select_none',
+                                        id=tabId('select_none', tab_value),
                                         style={"flex": "1", "margin": ".5rem"}
                                         ),
                         ]
                     ),
                     dcc.Dropdown(
-                        id=tab_value + '_dropdown',
+                        id=tabId('dropdown', tab_value),
                         className="dropdown",
                         value=[default_country],  # Value is list since multi=True
                         persistence=True,
@@ -197,13 +369,14 @@ def create_tab_content(tab_value):
                             "flex": "1 1 0",
                             "overflow": "auto"
                         },
-                        options=[
-                            {
-                                "label": i,
-                                "value": i
-                            } for i in dropdown_columns],
+                        options=dropdown_options,
                     ),
-
+                    # Selected regions' data for clientside views
+                    dcc.Store(id=tabId('store', tab_value), data=store),
+                    # What the dropdown's options list besides the usual regions (see selectRegions)
+                    dcc.Store(id=tabId('drill_down', tab_value), data=[[], []]),
+                    # The graph's last zoom and the uirevision it was made under (see zoomRange)
+                    dcc.Store(id=tabId('zoom', tab_value), data=None),
                 ]
             )]
 
@@ -214,11 +387,12 @@ def create_tab_content(tab_value):
                 className="graph_container",
                 children=[
                     dcc.Graph(
-                        id=tab_value + '_graph',
+                        id=tabId('graph', tab_value),
                         className="graph",
                         config={
                             "displayModeBar": False,
                             "responsive": True},
+                        figure=figure,
                     )
                 ]
             ),
@@ -233,17 +407,17 @@ def create_tab_content(tab_value):
                         className="button_container",
                         children=[
                             html.Button("Select All",
-                                        id=tab_value + '_select_all',
+                                        id=tabId('select_all', tab_value),
                                         style={"flex": "1", "margin": ".5rem"}
                                         ),
                             html.Button("Select None",
-                                        id=tab_value + '_select_none',
+                                        id=tabId('select_none', tab_value),
                                         style={"flex": "1", "margin": ".5rem"}
                                         ),
                         ]
                     ),
                     dcc.Dropdown(
-                        id=tab_value + '_dropdown',
+                        id=tabId('dropdown', tab_value),
                         className="dropdown",
                         value=["New Zealand"],
                         persistence=True,
@@ -253,302 +427,195 @@ def create_tab_content(tab_value):
                             "flex": "1 1 0",
                             "overflow": "auto"
                         },
-                        options=[
-                            {
-                                "label": i,
-                                "value": i
-                            } for i in cases.columns],
+                        options=dropdown_options,
                     ),
+                    # Selected regions' data for clientside views
+                    dcc.Store(id=tabId('store', tab_value), data=store),
+                    # What the dropdown's options list besides the usual regions (see selectRegions)
+                    dcc.Store(id=tabId('drill_down', tab_value), data=[[], []]),
+                    # The graph's last zoom and the uirevision it was made under (see zoomRange)
+                    dcc.Store(id=tabId('zoom', tab_value), data=None),
                 ]
             )]
 
 
-# The accumulators are a workaround to enable us to use dynamically generated elements as inputs.
-# Dash requires all inputs of a callback to exist at the time the callback is run (And only one callback to output to
-# each element). This is not possible with dynamically generated tabs, so we feed their values into the accumulators
-# to act as intermediaries
-@app.callback(
-    Output("header", "children"),
-    [Input("header_accumulator_cases", "children"),
-     Input("header_accumulator_deaths", "children")],
-)
-def update_header(value_cases, value_deaths):
-    ctx = dash.callback_context
-    values = json.loads(ctx.triggered[0]["value"])
-    if len(values["dropdown"])>0:
-        country = values["dropdown"][0]
-    else:
-        return dash.no_update
-
-    newvtotal = values["newvtotal"]
-
-    if ctx.triggered[0]["prop_id"] == "header_accumulator_cases.children":
-        if newvtotal == "total":
-            return locale.format_string(
-                "As of %s, there have been %d cases in total of COVID-19 in %s",
-                (cases[country].dropna().index[-1].strftime("%d %B %Y"),
-                 cases[country].dropna().iloc[-1],
-                 country),
-                grouping=True)
-        else:
-            number = casesNew[country].dropna().iloc[-1]
-            return locale.format_string(
-                "On %s, there were %d new cases of COVID-19 in %s",
-                (cases[country].dropna().index[-1].strftime("%d %B %Y"),
-                 number,
-                 country),
-                grouping=True)
-    elif ctx.triggered[0]["prop_id"] == "header_accumulator_deaths.children":
-        if newvtotal == "total":
-            return locale.format_string(
-                "As of %s, there have been %d deaths from COVID-19 in %s",
-                (deaths[country].dropna().index[-1].strftime("%d %B %Y"),
-                 deaths[country].dropna().iloc[-1],
-                 country),
-                grouping=True)
-        else:
-            number = deathsNew[country].dropna().iloc[-1]
-            return locale.format_string(
-                "On %s, there were %d new deaths from COVID-19 in %s ",
-                (deaths[country].dropna().index[-1].strftime("%d %B %Y"),
-                 number,
-                 country),
-                grouping=True)
-    else:
-        return dash.no_update
-
-
-@app.callback(
-    Output("cases_dropdown", "value"),
-    [Input("cases_select_all", "n_clicks"),
-     Input("cases_select_none", "n_clicks")],
-    [State('cases_dropdown', "options")]
-)
-def update_dropdown_cases(all_n_clicks, none_n_clicks, options):
-    ctx = dash.callback_context
-
-    if ctx.triggered[0]["value"] is None:
-        return [default_country]
-    else:
-        if ctx.triggered[0]["prop_id"] == "cases_select_all" + ".n_clicks":
-            return list(i.get("value") for i in options)
-        else:
-            return []
-
-
-@app.callback(
-    Output("deaths_dropdown", "value"),
-    [Input("deaths_select_all", "n_clicks"),
-     Input("deaths_select_none", "n_clicks")],
-    [State('deaths_dropdown', "options")]
-)
-def update_dropdown_deaths(all_n_clicks, none_n_clicks, options):
-    ctx = dash.callback_context
-
-    if ctx.triggered[0]["value"] is None:
-        return [default_country]
-    elif ctx.triggered[0]["prop_id"] == "deaths_select_all" + ".n_clicks":
-        return list(i.get("value") for i in options)
-    else:  # prop_id = select_none
-        return []
-
-
-@app.callback(
-    Output("newVsTotal_dropdown", "value"),
-    [Input("newVsTotal_select_all", "n_clicks"),
-     Input("newVsTotal_select_none", "n_clicks")],
-    [State('newVsTotal_dropdown', "options")]
-)
-def update_dropdown_newVsTotal(all_n_clicks, none_n_clicks, options):
-    ctx = dash.callback_context
-
-    if ctx.triggered[0]["value"] is None:
-        return [default_country]
-    elif ctx.triggered[0]["prop_id"] == "newVsTotal_select_all" + ".n_clicks":
-        return list(i.get("value") for i in options)
-    else:  # prop_id = select_none
-        return []
-
-
-@app.callback(
-    Output('cases_scale', "options"),
-    [Input('cases_new_v_total', "value")],
-    [State('cases_scale', 'options')]
-)
-def update_scale_options_cases(value, options):
-    if value == "new":
-        for item in options:
-            if item["value"] != "linear":
-                item["disabled"] = True
-        return options
-    else:
-        for item in options:
-            item["disabled"] = False
-        return options
-
-
-@app.callback(
-    Output('deaths_scale', "options"),
-    [Input('deaths_new_v_total', "value")],
-    [State('deaths_scale', 'options')]
-)
-def update_scale_options_deaths(value, options):
-    if value == "new":
-        for item in options:
-            if item["value"] != "linear":
-                item["disabled"] = True
-        return options
-    else:
-        for item in options:
-            item["disabled"] = False
-        return options
-
-
-@app.callback(
-    Output('cases_graph', "figure"),
-    [Input('cases_dropdown', "value"),
-     Input('cases_new_v_total', "value"),
-     Input('cases_scale', "value")]
-)
-def update_graph_cases(dropdown_value, newvtotal_value, scale_value):
-    # So we can copy paste these callbacks and only update values at top.
-    totalTitle = "Total cases of COVID-19<br> over time"
-    newTitle = "New cases of COVID-19<br> over time"
-    yLabel = "Confirmed cases"
-    perCapitaYLabel = 'Confirmed cases per 10,000 population'
-    data = cases if newvtotal_value == "total" else casesNew
-    dataText = casesText
-
-    if dropdown_value is None or len(dropdown_value) == 0:
-        return dash.no_update
+# The figure and clientside store data a tab's content starts with: the default view if it is prerendered, otherwise
+# an empty figure and no data. With clientside views the figure is drawn from the store in the browser.
+def defaultView(tab_value, snapshot):
+    if not prerenderDefaultView:
+        return {"data": [], "layout": {}}, None
+    if clientsideViews:
+        return {"data": [], "layout": {}}, createViewStore(tab_value, [default_country], snapshot)
+    if tab_value == "newVsTotal":
+        return createNewVsTotalFigure([default_country], None, snapshot), None
+    return createTimeFigure(tab_value, [default_country], "total", "linear", defaultAlignThreshold, None,
+                            snapshot), None
+
+
+# True for the first call for a tab whose content shows the prerendered default view, which needs nothing but the
+# header from the server. Persisted control values that differ from the defaults need the full update.
+def showsDefaultView(dropdown_value, newvtotal_values, scale_values):
+    return prerenderDefaultView and dash.callback_context.triggered_id is None and \
+        dropdown_value == [default_country] and all(value == "total" for value in newvtotal_values) and \
+        all(value == "linear" for value in scale_values)
+
+
+# The regions to show, and the value, options and drill down to give the dropdown and the tab's drill_down store. The
+# first call for a tab selects the default country, and the Select All and Select None buttons replace the selection;
+# otherwise the dropdown is left as it is. With region search the dropdown only has options for the selected regions
+# (it drops values that aren't in its options). Without it, changing the selection lists the counties of selected
+# states; drill_down holds what the options list beyond the usual regions (see RegionIndex.drillDown), so options
+# are only sent when that changes, including back to the full options when the states are deselected.
+def selectRegions(dropdown_value, drill_down):
+    triggered = dash.callback_context.triggered_id
+    triggeredType = triggered["type"] if triggered is not None else None
+    if triggeredType is None:
+        regions = [default_country]
+    elif triggeredType == "select_all":
+        regions = list(dataManager.get().cases.columns)
+    elif triggeredType == "select_none":
+        regions = []
+    elif triggeredType == "dropdown" and not region_search.regionSearch:
+        regions = dropdown_value
     else:
-        countryList = dropdown_value
+        # Other controls, and typing with region search, leave the dropdown as it is
+        return dropdown_value, dash.no_update, dash.no_update, dash.no_update
+    if region_search.regionSearch:
+        return regions, regions, region_search.createOptions(regions), dash.no_update
+
+    index = regionIndex(dataManager.get())
+    drillDown = index.drillDown(regions) if triggeredType == "dropdown" else [[], []]
+    if drillDown == (drill_down or [[], []]):
+        return regions, dash.no_update if triggeredType == "dropdown" else regions, dash.no_update, dash.no_update
+    options = index.drillDownOptions(regions) if triggeredType == "dropdown" else None
+    return (regions, dash.no_update if triggeredType == "dropdown" else regions,
+            options if options is not None else index.options, drillDown)
+
+
+# uirevision of a time graph: the graph keeps its zoom while this stays the same, and resets it when it changes
+def uiRevision(newvtotal_value, scale_value, threshold):
+    aligned = newvtotal_value == "total" and scale_value == "aligned"
+    return newvtotal_value + "-" + scale_value + ("-%d" % threshold if aligned else "")
+
+
+# The zoomed x range to send for a graph (None for the full range) and the data for the tab's zoom store, or
+# dash.no_update for both if the graph's relayoutData changed without changing the x range. relayoutData only has the
+# graph's last change and is kept after the zoom is reset by a new uirevision, when it may not even be in the units of
+# the new x axis, so a zoom is stored with the uirevision it was made under. Other changes use it while the graph
+# has that uirevision, as the browser keeps the graph zoomed, and send the full range once it has changed.
+def zoomRange(relayoutData, revision, zoom):
+    triggered = dash.callback_context.triggered_id or {}
+    if triggered.get("type") == "graph":
+        xRange = downsampling.relayoutXRange(relayoutData)
+        if xRange is None:
+            return dash.no_update, dash.no_update
+        return (None, None) if xRange == "auto" else (xRange, [revision, xRange])
+    if zoom is not None and zoom[0] == revision:
+        return zoom[1], dash.no_update
+    return None, None if zoom is not None else dash.no_update
+
+
+# Header text from the snapshot's latest values, so no series is searched for the last count
+def createHeader(tab_value, country, newvtotal_value, snapshot):
+    latest = derived_series.selectSeries(snapshot, tab_value, [country]).latest.loc[country]
+    text = tabText[tab_value]["totalHeader" if newvtotal_value == "total" else "newHeader"]
+    return locale.format_string(text, (latest["date"].strftime("%d %B %Y"), latest[newvtotal_value], country),
+                                grouping=True)
+
+
+# Figure for the cases or deaths graph. threshold is the count the aligned scale starts each region at.
+def createTimeFigure(tab_value, countryList, newvtotal_value, scale_value, threshold, xRange, snapshot):
+    text = tabText[tab_value]
+    threshold = alignThreshold(threshold)
+    aligned = newvtotal_value == "total" and scale_value == "aligned"
+
+    # Trace order sets the colours, so the regions are kept in the order selected. New only shows the first region.
+    # Zoomed views aren't cached
+    cacheKey = (tab_value, tuple(countryList) if newvtotal_value == "total" else (countryList[0],),
+                newvtotal_value, scale_value if newvtotal_value == "total" else None, threshold if aligned else None,
+                snapshot.version)
+    figure = figureCache.get(cacheKey) if xRange is None else None
+    if figure is not None:
+        return figure
+
+    series = derived_series.selectSeries(snapshot, tab_value, countryList if newvtotal_value == "total"
+                                         else countryList[:1])
+    data = series.total if newvtotal_value == "total" else series.new
+    labels, perCapita, start = series.labels, series.perCapita, series.start
 
     if newvtotal_value == "total":
-        graphData = [dict(
-                    x=data.index if scale_value != "log" else data.index[data[i] > 50],
-                    y=data[i] if scale_value == "linear" else data[i].loc[data.index[data[i] > 50]] if scale_value == "log" else 10000*data[i]/population.loc["Population", i],
+        # Log and aligned scales start each region where it reaches a threshold; aligned counts days from there
+        if aligned:
+            start = series.alignment.loc[threshold]
+        cut = scale_value in ["log", "aligned"]
+        maxPoints = downsampling.pointsPerTrace(len(countryList))
+        graphData = [downsampling.downsampleTrace(dict(
+                    x=data.index if not cut else np.arange(len(data) - start[i]) if aligned else data.index[start[i]:],
+                    y=data[i] if scale_value == "linear" else data[i].iloc[start[i]:] if cut else perCapita[i],
                     name=i,
-                    text=dataText[i].dropna() if scale_value != "log" else dataText[i].dropna().loc[data.index[data[i] > 50]],
+                    text=data_processing.labelText(i, labels[i], start[i] if cut else 0),
                     mode="lines+text",
                     textposition="top left"
-                ) for i in data[countryList].columns]
+                ), maxPoints, xRange) for i in data[countryList].columns]
 
         layout = dict(
-                    xaxis={'title': 'Time'},
-                    yaxis={'title': yLabel if scale_value != "per_capita" else perCapitaYLabel,
-                           "type": "linear" if scale_value != "log" else "log"},
+                    xaxis={'title': 'Time' if not aligned else text["alignedXLabel"] % ordinal(threshold)},
+                    yaxis={'title': text["yLabel"] if scale_value != "per_capita" else text["perCapitaYLabel"],
+                           "type": "linear" if not cut else "log"},
                     margin={'l': 50, 'b': 40, 't': 40, 'r': 20},
                     hovermode='closest',
-                    title=totalTitle,
+                    title=text["totalTitle"] if not aligned else text["alignedTitle"] % ordinal(threshold),
                     showlegend=False,
                 )
     else:  # newvtotal_value = new
-        graphData = [dict(
+        graphData = [downsampling.downsampleTrace(dict(
             x=data.index,
             y=data[i],
             name=i,
             type="bar",
             textposition="top left"
-        ) for i in data[countryList[0]].to_frame().columns]
+        ), None, xRange) for i in data[countryList[0]].to_frame().columns]
 
         layout = dict(
             xaxis={'title': 'Time'},
-            yaxis={'title': yLabel,
+            yaxis={'title': text["yLabel"],
                    "type": "linear"},
             margin={'l': 50, 'b': 40, 't': 40, 'r': 20},
             hovermode='closest',
-            title=newTitle,
+            title=text["newTitle"],
             showlegend=False,)
 
-    return {'data': graphData,
-            'layout': layout}
+    # Keep the zoom when regions are added or removed
+    layout["uirevision"] = uiRevision(newvtotal_value, scale_value, threshold)
+    if xRange is not None:
+        layout["xaxis"]["range"] = xRange
+        return figure_encoding.encodeFigure({'data': graphData,
+                                             'layout': layout})
 
+    return figureCache.put(cacheKey, figure_encoding.encodeFigure({'data': graphData,
+                                                                   'layout': layout}))
 
-@app.callback(
-    Output('deaths_graph', "figure"),
-    [Input('deaths_dropdown', "value"),
-     Input('deaths_new_v_total', "value"),
-     Input('deaths_scale', "value")]
-)
-def update_graph_deaths(dropdown_value, newvtotal_value, scale_value):
-    # So we can copy paste these callbacks and only update values at top.
-    totalTitle = "Deaths from COVID-19<br> over time"
-    newTitle = "Change in deaths from COVID-19<br> over time"
-    yLabel = "Deaths"
-    perCapitaYLabel = 'Deaths per 10,000 population'
-    data = deaths if newvtotal_value == "total" else deathsNew
-    dataText = deathsText
-
-    if dropdown_value is None or len(dropdown_value) == 0:
-        return dash.no_update
-    else:
-        countryList = dropdown_value
 
-    if newvtotal_value == "total":
-        graphData = [dict(
-            x=data.index if scale_value != "log" else data.index[data[i] > 50],
-            y=data[i] if scale_value == "linear" else data[i].loc[
-                data.index[data[i] > 50]] if scale_value == "log" else 10000 * data[i] / population.loc[
-                "Population", i],
-            name=i,
-            text=dataText[i].dropna() if scale_value != "log" else dataText[i].dropna().loc[data.index[data[i] > 50]],
-            mode="lines+text",
-            textposition="top left"
-        ) for i in data[countryList].columns]
+def createNewVsTotalFigure(countryList, xRange, snapshot):
+    cacheKey = ("newVsTotal", tuple(countryList), None, None, snapshot.version)
+    figure = figureCache.get(cacheKey) if xRange is None else None
+    if figure is not None:
+        return figure
 
-        layout = dict(
-            xaxis={'title': 'Time'},
-            yaxis={'title': yLabel if scale_value != "per_capita" else perCapitaYLabel,
-                   "type": "linear" if scale_value != "log" else "log"},
-            margin={'l': 50, 'b': 40, 't': 40, 'r': 20},
-            hovermode='closest',
-            title=totalTitle,
-            showlegend=False,
-        )
-    else:  # newvtotal_value = new
-        graphData = [dict(
-            x=data.index,
-            y=data[i],
-            name=i,
-            type="bar",
-            textposition="top left"
-        ) for i in data[countryList[0]].to_frame().columns]
-
-        layout = dict(
-            xaxis={'title': 'Time'},
-            yaxis={'title': yLabel,
-                   "type": "linear"},
-            margin={'l': 50, 'b': 40, 't': 40, 'r': 20},
-            hovermode='closest',
-            title=newTitle,
-            showlegend=False, )
-
-    return {'data': graphData,
-            'layout': layout}
-
-
-@app.callback(
-    Output('newVsTotal_graph', "figure"),
-    [Input('newVsTotal_dropdown', "value")]
-)
-def update_graph_newVsTotal(value):
-
-    if value is None or len(value) == 0:
-        return dash.no_update
-    else:
-        countryList = value
+    series = derived_series.selectSeries(snapshot, "cases", countryList)
+    cases, labels, casesNew7Day, start = series.total, series.labels, series.new7Day, series.start
 
-    newData = [dict(
+    maxPoints = downsampling.pointsPerTrace(len(countryList))
+    newData = [downsampling.downsampleTrace(dict(
                 # Starting at the point where total cases > 50 (different times and lengths for each country)
-                x=cases[i].loc[cases.index[cases[i] > 50]],
-                y=casesNew[i].rolling(pd.to_timedelta("7days")).sum().loc[cases.index[cases[i] > 50]],
+                x=cases[i].iloc[start[i]:],
+                y=casesNew7Day[i].iloc[start[i]:],
                 name=i,
-                text=casesText[i].dropna().loc[cases.index[cases[i] > 50]],
+                text=data_processing.labelText(i, labels[i], start[i]),
                 mode="lines+text",
                 textposition="top left"
-            ) for i in cases[countryList].columns]
-    return {
+            ), maxPoints, xRange, logX=True) for i in cases[countryList].columns]
+    figure = {
                 'data': newData,
                 'layout': dict(
                     xaxis={'title': 'Total cases',
@@ -559,33 +626,316 @@ def update_graph_newVsTotal(value):
                     hovermode='closest',
                     title="New cases of COVID-19<br> vs total cases",
                     showlegend=False,
+                    # Keep the zoom when regions are added or removed
+                    uirevision="newVsTotal",
                 )
             }
-
-@app.callback(
-    Output('header_accumulator_cases', 'children'),
-    [Input('cases_dropdown', "value"),
-     Input('cases_new_v_total', "value")]
-)
-def update_header_accumulator_cases(dropdown, newvtotal):
-    return json.dumps(dict(
-        dropdown=dropdown,
-        newvtotal=newvtotal
-    ))
-
-
-@app.callback(
-    Output('header_accumulator_deaths', 'children'),
-    [Input('deaths_dropdown', "value"),
-     Input('deaths_new_v_total', "value")]
+    if xRange is not None:
+        figure["layout"]["xaxis"]["range"] = xRange
+        return figure_encoding.encodeFigure(figure)
+
+    return figureCache.put(cacheKey, figure_encoding.encodeFigure(figure))
+
+
+# Everything that depends on a tab's controls is updated in one request: the dropdown when a select button is
+# pressed or its options change, the zoom store, the graph, the scale options and the header. Each output is a list
+# with an entry for the shown tab.
+@serverViewCallback(
+    [Output(tabId('dropdown', ALL), "value"),
+     Output(tabId('dropdown', ALL), "options"),
+     Output(tabId('drill_down', ALL), "data"),
+     Output(tabId('zoom', ALL), "data"),
+     Output(tabId('graph', ALL), "figure"),
+     Output(tabId('scale', ALL), "options"),
+     Output("header", "children")],
+    [Input(tabId('dropdown', ALL), "value"),
+     Input(tabId('new_v_total', ALL), "value"),
+     Input(tabId('scale', ALL), "value"),
+     Input(tabId('threshold', ALL), "value"),
+     Input(tabId('select_all', ALL), "n_clicks"),
+     Input(tabId('select_none', ALL), "n_clicks"),
+     Input(tabId('graph', ALL), "relayoutData")],
+    [State(tabId('drill_down', ALL), "data"),
+     State(tabId('zoom', ALL), "data")]
 )
-def update_header_accumulator_deaths(dropdown, newvtotal):
-    return json.dumps(dict(
-        dropdown=dropdown,
-        newvtotal=newvtotal
-    ))
-
-
+def update_tab(dropdown_values, newvtotal_values, scale_values, threshold_values, all_n_clicks, none_n_clicks,
+               relayout_data, drill_down_values, zoom_values):
+    if len(dropdown_values) == 0:
+        return [], [], [], [], [], [], dash.no_update
+    tab_value = shownTab()
+    unchanged = [[dash.no_update], [dash.no_update], [dash.no_update], [dash.no_update], [dash.no_update],
+                 [dash.no_update] * len(scale_values), dash.no_update]
+    if showsDefaultView(dropdown_values[0], newvtotal_values, scale_values):
+        if tab_value == "newVsTotal":
+            return unchanged
+        return unchanged[:6] + [createHeader(tab_value, default_country, "total", dataManager.get())]
+    countryList, dropdown_value, dropdown_options, drill_down = selectRegions(dropdown_values[0],
+                                                                              drill_down_values[0])
+    dropdown = [[dropdown_value], [dropdown_options], [drill_down]]
+
+    if countryList is None or len(countryList) == 0:
+        return dropdown + unchanged[3:]
+
+    snapshot = dataManager.get()
+    if tab_value == "newVsTotal":
+        xRange, zoom = zoomRange(relayout_data[0], "newVsTotal", zoom_values[0])
+        if xRange is dash.no_update:
+            return unchanged
+        return dropdown + [[zoom], [createNewVsTotalFigure(countryList, xRange, snapshot)], [], dash.no_update]
+
+    newvtotal_value, scale_value, threshold = newvtotal_values[0], scale_values[0], threshold_values[0]
+    xRange, zoom = zoomRange(relayout_data[0], uiRevision(newvtotal_value, scale_value, threshold), zoom_values[0])
+    if xRange is dash.no_update:
+        return unchanged
+    return dropdown + [[zoom],
+                       [createTimeFigure(tab_value, countryList, newvtotal_value, scale_value, threshold, xRange,
+                                         snapshot)],
+                       [createScaleOptions(tab_value, newvtotal_value)],
+                       createHeader(tab_value, countryList[0], newvtotal_value, snapshot)]
+
+
+# Replace NaN with None so a series can be sent as JSON
+def jsonValues(series):
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+# Data for the selected regions, from which the clientside figures function draws the tab's graph for every scale
+# and new/total view, and the header. Values are sent once per selection; lines are downsampled the same way as
+# server side figures.
+def createViewStore(tab_value, countryList, snapshot):
+    maxPoints = downsampling.pointsPerTrace(len(countryList))
+
+    if tab_value == "newVsTotal":
+        series = derived_series.selectSeries(snapshot, "cases", countryList)
+        cases, labels, casesNew7Day, start = series.total, series.labels, series.new7Day, series.start
+        regions = []
+        for i in cases[countryList].columns:
+            trace = downsampling.downsampleTrace(dict(
+                x=cases[i].iloc[start[i]:],
+                y=casesNew7Day[i].iloc[start[i]:],
+                text=data_processing.labelText(i, labels[i], start[i]),
+            ), maxPoints)
+            regions.append(dict(name=i, x=jsonValues(trace["x"]), y=jsonValues(trace["y"]), text=trace["text"]))
+        return dict(tab=tab_value, regions=regions)
+
+    series = derived_series.selectSeries(snapshot, tab_value, countryList)
+    data, dataNew, labels, start, alignment = series.total, series.new, series.labels, series.start, series.alignment
+    population = snapshot.population
+    dates = data.index
+    regions = []
+    for i in data[countryList].columns:
+        points = None
+        if maxPoints is not None and len(data) > maxPoints:
+            points = downsampling.lttb(dates.asi8, data[i], maxPoints, keep=[labels[i]])
+        total = data[i] if points is None else data[i].iloc[points]
+        regionPopulation = pd.to_numeric(population.loc["Population"].get(i), errors="coerce")
+        regions.append(dict(
+            name=i,
+            total=total.tolist(),
+            points=points.tolist() if points is not None else None,
+            label=int(labels[i]),
+            start=int(start[i]),
+            alignment={str(threshold): int(position) for threshold, position in alignment[i].items()},
+            population=float(regionPopulation) if pd.notna(regionPopulation) else None,
+        ))
+    return dict(
+        tab=tab_value,
+        dates=dates.strftime("%Y-%m-%d").tolist(),
+        regions=regions,
+        # New is only shown for the first region
+        new=jsonValues(dataNew[countryList[0]]),
+        text=tabText[tab_value],
+        # Titles of the aligned view for each threshold, and the threshold used for any other
+        aligned={str(threshold): dict(title=tabText[tab_value]["alignedTitle"] % ordinal(threshold),
+                                      xLabel=tabText[tab_value]["alignedXLabel"] % ordinal(threshold))
+                 for threshold in derived_series.alignThresholds},
+        defaultThreshold=defaultAlignThreshold,
+        header=dict(total=createHeader(tab_value, countryList[0], "total", snapshot),
+                    new=createHeader(tab_value, countryList[0], "new", snapshot)),
+    )
+
+
+if clientsideViews:
+    @app.callback(
+        [Output(tabId('dropdown', ALL), "value"),
+         Output(tabId('dropdown', ALL), "options"),
+         Output(tabId('drill_down', ALL), "data"),
+         Output(tabId('store', ALL), "data")],
+        [Input(tabId('dropdown', ALL), "value"),
+         Input(tabId('select_all', ALL), "n_clicks"),
+         Input(tabId('select_none', ALL), "n_clicks")],
+        [State(tabId('drill_down', ALL), "data")]
+    )
+    def update_store(dropdown_values, all_n_clicks, none_n_clicks, drill_down_values):
+        if len(dropdown_values) == 0:
+            return [], [], [], []
+        tab_value = shownTab()
+        if showsDefaultView(dropdown_values[0], [], []):
+            return [dash.no_update], [dash.no_update], [dash.no_update], [dash.no_update]
+        countryList, dropdown_value, dropdown_options, drill_down = selectRegions(dropdown_values[0],
+                                                                                  drill_down_values[0])
+        dropdown = [[dropdown_value], [dropdown_options], [drill_down]]
+        if countryList is None or len(countryList) == 0:
+            return dropdown + [[dash.no_update]]
+        return dropdown + [[createViewStore(tab_value, countryList, dataManager.get())]]
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="figures", function_name="tab_view"),
+        [Output(tabId('graph', ALL), "figure"),
+         Output(tabId('scale', ALL), "options"),
+         Output("header", "children")],
+        [Input(tabId('store', ALL), "data"),
+         Input(tabId('new_v_total', ALL), "value"),
+         Input(tabId('scale', ALL), "value"),
+         Input(tabId('threshold', ALL), "value")],
+        [State(tabId('scale', ALL), "options")],
+    )
+
+
+if region_search.regionSearch:
+    # Options for the regions matching what has been typed, keeping the selected regions so they stay selected
+    @app.callback(
+        Output(tabId('dropdown', MATCH), "options", allow_duplicate=True),
+        [Input(tabId('dropdown', MATCH), "search_value")],
+        [State(tabId('dropdown', MATCH), "value")],
+        prevent_initial_call=True,
+    )
+    def search_regions(search_value, value):
+        if not search_value:
+            return dash.no_update
+        selected = value or []
+        matches = regionIndex(dataManager.get()).search(search_value)
+        return region_search.createOptions(selected + [i for i in matches if i not in selected])
+
+
+# Responses of the data API depend only on the data version and the query, so they get a strong ETag made of the two,
+# and can be cached until the next refresh is due (a day if data isn't refreshed). Repeat requests can then be answered
+# by a reverse proxy or CDN, or with a 304 here without building the response.
+apiMaxAge = int(os.environ.get("API_MAX_AGE", 24 * 60 * 60))
+
+
+def apiETag(snapshot, *query):
+    return "%s-%s" % (snapshot.version, hashlib.sha1(json.dumps(query).encode("utf-8")).hexdigest()[:16])
+
+
+def apiResponse(response, etag):
+    response.set_etag(etag)
+    maxAge = apiMaxAge
+    if dataManager.refresh_interval > 0:
+        maxAge = max(0, min(maxAge, int(dataManager.refresh_interval - (dataManager.age() or 0))))
+    response.headers["Cache-Control"] = "public, max-age=%d" % maxAge
+    return response
+
+
+# A 304 response if the client has the response for etag. Flask-Compress adds the encoding to the ETag of compressed
+# responses ("<etag>:gzip"), and the 304 has to repeat the one the client has.
+def notModified(etag):
+    for tag in flask.request.if_none_match:
+        if tag == etag or tag.startswith(etag + ":"):
+            return apiResponse(flask.Response(status=304), tag)
+    return None
+
+
+# Regions asked for with ?region= (repeated) or ?regions= (separated by "|", as names contain commas), or every
+# country and state. Returns the regions, or None and an error response for an unknown region.
+def apiRegions(snapshot):
+    args = flask.request.args
+    regions = args.getlist("region") + [region for value in args.getlist("regions")
+                                        for region in value.split("|") if region]
+    regions = list(dict.fromkeys(regions)) or list(snapshot.cases.columns)
+    for region in regions:
+        if region not in snapshot.regions.index:
+            return None, (flask.jsonify(error="Unknown region: %s" % region), 404)
+    return regions, None
+
+
+# Latest date, total and new counts of cases and deaths for every country and state, or the regions (including US
+# counties) given as ?region=
+@server.route("/api/latest")
+def latest_numbers():
+    snapshot = dataManager.get()
+    regions, error = apiRegions(snapshot)
+    if error is not None:
+        return error
+    etag = apiETag(snapshot, "latest", regions)
+    cached = notModified(etag)
+    if cached is not None:
+        return cached
+    tabLatest = {tab_value: derived_series.selectSeries(snapshot, tab_value, regions).latest
+                 for tab_value in ["cases", "deaths"]}
+    latest = {}
+    for region in regions:
+        latest[region] = {}
+        for tab_value in ["cases", "deaths"]:
+            values = tabLatest[tab_value].loc[region]
+            latest[region][tab_value] = dict(
+                date=values["date"].strftime("%Y-%m-%d") if pd.notna(values["date"]) else None,
+                total=int(values["total"]) if pd.notna(values["total"]) else None,
+                new=int(values["new"]) if pd.notna(values["new"]) else None,
+            )
+    return apiResponse(flask.jsonify(version=snapshot.version, regions=latest), etag)
+
+
+seriesMetrics = ["cases", "deaths"]
+seriesTransforms = ["total", "new", "per_capita", "new_7day"]
+# Rows per chunk of a streamed CSV response
+csvChunkRows = 100
+
+
+# Daily values of a metric for the regions: total or new counts, total per 10,000 population, or new counts over the
+# last derived_series.rollingDays days
+def seriesFrame(snapshot, metric, transform, regions):
+    series = derived_series.selectSeries(snapshot, metric, regions)
+    if transform == "total":
+        frame = series.total
+    elif transform == "new":
+        frame = series.new
+    elif transform == "per_capita":
+        frame = series.perCapita
+    elif series.new7Day is not None:
+        frame = series.new7Day
+    else:
+        frame = derived_series.rollingSum(series.new[regions],
+                                          pd.to_timedelta("%ddays" % derived_series.rollingDays))
+    return frame[regions]
+
+
+# The frame as CSV in chunks of rows, so large selections are sent as they are formatted
+def csvChunks(frame):
+    yield frame.iloc[:0].to_csv(index_label="date")
+    for start in range(0, len(frame), csvChunkRows):
+        yield frame.iloc[start:start + csvChunkRows].to_csv(header=False, date_format="%Y-%m-%d",
+                                                           float_format="%.10g")
+
+
+# Time series of a metric for a batch of regions, e.g. /api/series?region=New Zealand&metric=cases&transform=per_capita
+# metric is cases or deaths, transform one of seriesTransforms and format json (dates and a list of values for each
+# region, null where there is no value) or csv (a date column and a column for each region).
+@server.route("/api/series")
+def time_series():
+    snapshot = dataManager.get()
+    metric = flask.request.args.get("metric", "cases")
+    transform = flask.request.args.get("transform", "total")
+    format = flask.request.args.get("format", "json")
+    if metric not in seriesMetrics or transform not in seriesTransforms or format not in ["json", "csv"]:
+        return flask.jsonify(error="metric must be one of %s, transform one of %s and format json or csv" % (
+            ", ".join(seriesMetrics), ", ".join(seriesTransforms))), 400
+    regions, error = apiRegions(snapshot)
+    if error is not None:
+        return error
+    etag = apiETag(snapshot, "series", regions, metric, transform, format)
+    cached = notModified(etag)
+    if cached is not None:
+        return cached
+
+    frame = seriesFrame(snapshot, metric, transform, regions)
+    if format == "csv":
+        response = flask.Response(csvChunks(frame), mimetype="text/csv")
+    else:
+        response = flask.jsonify(version=snapshot.version, metric=metric, transform=transform,
+                                 dates=frame.index.strftime("%Y-%m-%d").tolist(),
+                                 regions={region: jsonValues(frame[region]) for region in regions})
+    return apiResponse(response, etag)
 
 
 app.clientside_callback(
@@ -15,19 +15,25 @@ function allDescendantsAutocompleteOffWithId(id)
     allDescendantsAutocompleteOff(document.getElementById(id))
 }
 
+// Element id Dash gives the tab's dropdown (a pattern matching id, see tabId in app.py)
+function dropdownId(tab)
+{
+    return JSON.stringify({tab: tab, type: "dropdown"})
+}
+
 if (!window.dash_clientside) {
   window.dash_clientside = {};
 }
 window.dash_clientside.clientside = {
   autocomplete_off: function(value) {
-    setTimeout(allDescendantsAutocompleteOffWithId,1500, value + "_dropdown")
+    setTimeout(allDescendantsAutocompleteOffWithId,1500, dropdownId(value))
     return null;
   }
 };
 
 
 // Run on load (need func so get element doesn't get evaluated until after timeout)
-setTimeout(allDescendantsAutocompleteOffWithId,5000,"cases_dropdown")
+setTimeout(allDescendantsAutocompleteOffWithId,5000,dropdownId("cases"))
 
 
 
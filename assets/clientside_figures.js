@@ -0,0 +1,108 @@
+// Figures and header for the shown tab drawn from the data in the tab's store (see createViewStore in app.py),
+// so changing the scale or new/total doesn't need a request to the server.
+
+if (!window.dash_clientside) {
+  window.dash_clientside = {};
+}
+
+function viewLayout(title, yTitle, yType) {
+  return {
+    xaxis: {title: "Time"},
+    yaxis: {title: yTitle, type: yType},
+    margin: {l: 50, b: 40, t: 40, r: 20},
+    hovermode: "closest",
+    title: title,
+    showlegend: false,
+  };
+}
+
+// Log and aligned scales start each region where it reaches a threshold; aligned counts days from there
+function regionTrace(store, region, scale, threshold) {
+  var x = [], y = [], text = [];
+  var cut = scale === "log" || scale === "aligned";
+  var start = scale === "aligned" ? region.alignment[threshold] : region.start;
+  for (var i = 0; i < region.total.length; i++) {
+    // Position of this point in the full series
+    var position = region.points ? region.points[i] : i;
+    if (cut && position < start) {
+      continue;
+    }
+    var value = region.total[i];
+    if (scale === "per_capita") {
+      value = region.population ? 10000 * value / region.population : null;
+    }
+    x.push(scale === "aligned" ? position - start : store.dates[position]);
+    y.push(value);
+    text.push(position === region.label ? region.name : "");
+  }
+  return {x: x, y: y, name: region.name, text: text, mode: "lines+text", textposition: "top left"};
+}
+
+function timeFigure(store, newvtotal, scale, threshold) {
+  var figure;
+  // Thresholds persisted in the browser that the server no longer has fall back to the default
+  if (!(threshold in store.aligned)) {
+    threshold = store.defaultThreshold;
+  }
+  var aligned = store.aligned[threshold];
+  if (newvtotal === "total") {
+    figure = {
+      data: store.regions.map(function(region) { return regionTrace(store, region, scale, threshold); }),
+      layout: viewLayout(scale === "aligned" ? aligned.title : store.text.totalTitle,
+                         scale === "per_capita" ? store.text.perCapitaYLabel : store.text.yLabel,
+                         scale === "log" || scale === "aligned" ? "log" : "linear"),
+    };
+    if (scale === "aligned") {
+      figure.layout.xaxis.title = aligned.xLabel;
+    }
+  } else {
+    figure = {
+      data: [{x: store.dates, y: store.new, name: store.regions[0].name, type: "bar", textposition: "top left"}],
+      layout: viewLayout(store.text.newTitle, store.text.yLabel, "linear"),
+    };
+  }
+  figure.layout.uirevision = newvtotal + "-" + scale + (newvtotal === "total" && scale === "aligned" ?
+                                                        "-" + threshold : "");
+  return figure;
+}
+
+function newVsTotalFigure(store) {
+  return {
+    data: store.regions.map(function(region) {
+      return {x: region.x, y: region.y, name: region.name, text: region.text, mode: "lines+text",
+              textposition: "top left"};
+    }),
+    layout: {
+      xaxis: {title: "Total cases", type: "log"},
+      yaxis: {title: "New cases in past 7 days", type: "log"},
+      margin: {l: 50, b: 40, t: 40, r: 20},
+      hovermode: "closest",
+      title: "New cases of COVID-19<br> vs total cases",
+      showlegend: false,
+      uirevision: "newVsTotal",
+    },
+  };
+}
+
+// Only the linear scale applies to new cases
+function scaleOptions(newvtotal, options) {
+  return options.map(function(item) {
+    return Object.assign({}, item, {disabled: newvtotal === "new" && item.value !== "linear"});
+  });
+}
+
+window.dash_clientside.figures = {
+  // Arguments and outputs other than the header are lists with an entry for the shown tab (see tabId in app.py)
+  tab_view: function(stores, newvtotals, scales, thresholds, options) {
+    var no_update = window.dash_clientside.no_update;
+    var store = stores[0];
+    if (!store) {
+      return [stores.map(function() { return no_update; }), scales.map(function() { return no_update; }), no_update];
+    }
+    if (store.tab === "newVsTotal") {
+      return [[newVsTotalFigure(store)], [], no_update];
+    }
+    var newvtotal = newvtotals[0], scale = scales[0];
+    return [[timeFigure(store, newvtotal, scale, thresholds[0])], [scaleOptions(newvtotal, options[0])], store.header[newvtotal]];
+  },
+};
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import Request, urlopen
+
+from benchmarks import synthetic
+from benchmarks.bench_startup import firstGraphRequest, freePort, repoDir, serverCode, waitFor
+
+# Time from requesting the layout to having the default chart, with the default view prerendered into the layout and
+# without (PRERENDER_DEFAULT_VIEW=0), against a running server with its data loaded. Without prerendering the page has
+# to ask for the tab's content and then the graph before anything is drawn. --latency adds a round trip time to each
+# request, as a browser away from the server would see.
+# Run from the repository root: python -m benchmarks.bench_first_chart
+
+
+def post(url, body):
+    return Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+
+
+def read(request, latency):
+    time.sleep(latency)
+    with urlopen(request) as response:
+        return json.load(response)
+
+
+# Whether a layout or callback response holds a figure with data
+def hasChart(node):
+    if isinstance(node, dict):
+        if isinstance(node.get("figure"), dict) and node["figure"].get("data"):
+            return True
+        return any(hasChart(value) for value in node.values())
+    if isinstance(node, list):
+        return any(hasChart(value) for value in node)
+    return False
+
+
+# The requests the page makes until it can draw the default chart. Returns the seconds taken and the number of requests
+def firstChart(baseURL, graphRequest, latency):
+    start = time.perf_counter()
+    layout = read(baseURL + "/_dash-layout", latency)
+    requests = 1
+    if not hasChart(layout):
+        read(post(baseURL + "/_dash-update-component", dict(
+            output="main_row.children", outputs=dict(id="main_row", property="children"),
+            inputs=[dict(id="tab_selector", property="value", value="cases")], state=[],
+            changedPropIds=[])), latency)
+        response = read(graphRequest, latency)
+        requests += 2
+        if not hasChart(response):
+            raise RuntimeError("no chart in the graph response")
+    return time.perf_counter() - start, requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds of round trip time added per request")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    paths = synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                      args.regions, args.counties, args.days)
+    cacheDir = tempfile.mkdtemp(prefix="covid-nz-cache-")
+    for prerender in ["1", "0"]:
+        environment = dict(os.environ, DATA_REFRESH_INTERVAL="0", DATA_CACHE_DIR=cacheDir,
+                           SNAPSHOT_DIR=os.path.join(cacheDir, "snapshot"), PRERENDER_DEFAULT_VIEW=prerender)
+        port = freePort()
+        baseURL = "http://127.0.0.1:%d" % port
+        process = subprocess.Popen([sys.executable, "-c", serverCode, json.dumps(paths), str(port)], cwd=repoDir,
+                                   env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            process.stdout.readline()
+            waitFor(baseURL + "/_dash-layout", process, args.timeout)
+            graphRequest = firstGraphRequest(baseURL)
+            # Fill the figure cache, as it would be after the first visitor
+            firstChart(baseURL, graphRequest, 0)
+            results = sorted(firstChart(baseURL, graphRequest, args.latency) for run in range(args.runs))
+        finally:
+            process.terminate()
+            process.wait()
+        print("prerender=%s first chart median %.3fs, min %.3fs, %d requests (%.0fms latency each)" % (
+            prerender, results[len(results) // 2][0], results[0][0], results[0][1], args.latency * 1000))
+
+
+if __name__ == "__main__":
+    main()
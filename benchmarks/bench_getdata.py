@@ -0,0 +1,50 @@
+import argparse
+import tempfile
+import time
+
+import data_fetch
+import data_processing
+import metrics
+from benchmarks import fixture_server, synthetic
+
+# Time getData against synthetic files served locally, comparing fetching the four sources one at a time with
+# fetching them concurrently. Run from the repository root: python -m benchmarks.bench_getdata
+
+
+# Seconds recorded for each source so far
+def sourceTotals():
+    return {key: total for key, (buckets, count, total) in metrics.sourceSeconds.values().items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds added to each response")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    fixtureDir = tempfile.mkdtemp(prefix="covid-nz-fixtures-")
+    synthetic.writeJohnsFiles(fixtureDir, args.regions, args.counties, args.days)
+    server, baseURL = fixture_server.serve(fixtureDir, latency=args.latency)
+    synthetic.useJohnsFiles({name: baseURL + fileName for name, fileName in synthetic.fileNames.items()})
+
+    try:
+        for workers in args.workers:
+            data_processing.fetchWorkers = workers
+            # Fresh cache each time so every run downloads and parses everything
+            data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+            before = sourceTotals()
+            start = time.perf_counter()
+            data_processing.getData()
+            elapsed = time.perf_counter() - start
+            timings = [total - before.get(source, 0) for source, total in sourceTotals().items()]
+            print("workers=%d getData %.2fs, slowest source %.2fs, sum of sources %.2fs" % (
+                workers, elapsed, max(timings), sum(timings)))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+import data_fetch
+import data_manager
+import shared_snapshot
+from benchmarks import synthetic
+from benchmarks.bench_memory import residentMemory
+from benchmarks.bench_startup import freePort, outputSpecs, repoDir, specId, specKey, waitFor
+
+# Load test of the app as deployed: gunicorn serving app:server, its workers booting from a snapshot built from
+# synthetic files so nothing is downloaded. Simulated users replay the requests the page makes during a visit (page
+# load, scale and new/total toggles, dropdown changes, tab switches, select all) as fast as they are answered, or with
+# --think seconds between them. Reports throughput, p50/p95/p99 latency of each kind of request and the memory of the
+# workers. The users are threads of this process, so on a small machine they compete with the server for CPU.
+# Run from the repository root: python -m benchmarks.bench_load --workers 2 --threads 4 --concurrency 8
+
+defaultValues = {("dropdown", "value"): ["New Zealand"], ("new_v_total", "value"): "total",
+                 ("scale", "value"): "linear", ("threshold", "value"): 100}
+# Controls in each tab's content
+timeControls = {"graph", "new_v_total", "scale", "threshold", "select_all", "select_none", "dropdown", "store",
+                "drill_down", "zoom"}
+tabControls = {"cases": timeControls, "deaths": timeControls,
+               "newVsTotal": timeControls - {"new_v_total", "scale", "threshold"}}
+
+
+# Body of a callback request for the controls of tab, with values mapping (type or id, property) to the value of an
+# input and changed the (type or id, property) that triggered it, None for the first call after the controls appear
+def callbackBody(dependency, tab, values, changed=None):
+    def items(spec, withValue):
+        id = specId(spec)
+        key = (specKey(spec), spec["property"])
+        if isinstance(id, dict):
+            if id["type"] not in tabControls[tab]:
+                return []
+            id = dict(id, tab=tab)
+        item = dict(id=id, property=spec["property"])
+        if withValue:
+            item["value"] = values.get(key)
+        return [item] if isinstance(item["id"], dict) else item
+
+    changedPropIds = []
+    if changed is not None:
+        id = dict(type=changed[0], tab=tab) if changed[0] in timeControls else changed[0]
+        changedPropIds = [(json.dumps(id, sort_keys=True, separators=(",", ":")) if isinstance(id, dict) else id) +
+                          "." + changed[1]]
+    outputs = [items(spec, False) for spec in outputSpecs(dependency)]
+    return dict(output=dependency["output"],
+                outputs=outputs if dependency["output"].startswith("..") else outputs[0],
+                inputs=[items(spec, True) for spec in dependency["inputs"]],
+                state=[items(spec, True) for spec in dependency.get("state", [])],
+                changedPropIds=changedPropIds)
+
+
+# The requests of one visit as (name, method, path, body). Names are the request, or the callback and what triggered it
+def session(rng, regions, tabDependency, contentDependency):
+    steps = [("GET /", "GET", "/", None), ("GET /_dash-layout", "GET", "/_dash-layout", None),
+             ("GET /_dash-dependencies", "GET", "/_dash-dependencies", None)]
+
+    inputs = {(specKey(spec), spec["property"]) for spec in tabDependency["inputs"]}
+
+    # Changes of controls that aren't inputs (scale and new/total with clientside views) make no request
+    def tabCall(tab, values, changed):
+        if changed is not None and changed not in inputs:
+            return
+        name = "tab callback: " + (changed[0] if changed is not None else "initial")
+        steps.append((name, "POST", "/_dash-update-component", callbackBody(tabDependency, tab, values, changed)))
+
+    def switchTab(tab):
+        steps.append(("create_tab_content", "POST", "/_dash-update-component",
+                      callbackBody(contentDependency, tab, {("tab_selector", "value"): tab},
+                                   ("tab_selector", "value"))))
+        tabCall(tab, defaultValues, None)
+
+    values = dict(defaultValues)
+    tabCall("cases", values, None)
+    values[("dropdown", "value")] = ["New Zealand"] + rng.sample(regions, 2)
+    tabCall("cases", values, ("dropdown", "value"))
+    for scale in ["log", "per_capita", "aligned"]:
+        values[("scale", "value")] = scale
+        tabCall("cases", values, ("scale", "value"))
+    values[("new_v_total", "value")] = "new"
+    tabCall("cases", values, ("new_v_total", "value"))
+
+    switchTab("deaths")
+    values = dict(defaultValues)
+    values[("select_all", "n_clicks")] = 1
+    tabCall("deaths", values, ("select_all", "n_clicks"))
+
+    switchTab("newVsTotal")
+    values = dict(defaultValues)
+    values[("dropdown", "value")] = ["New Zealand"] + rng.sample(regions, 3)
+    tabCall("newVsTotal", values, ("dropdown", "value"))
+    return steps
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+
+    # Seconds taken by the request, raising for a failed one
+    def send(self, method, path, body):
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                    headers={"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+        if response.status >= 400:
+            raise RuntimeError("%s %s: %d" % (method, path, response.status))
+        return time.perf_counter() - start
+
+
+# Run sessions on one connection until deadline, adding each request's time to timings[name] once measuring starts
+def user(port, seed, regions, dependencies, think, measureFrom, deadline, timings, errors):
+    rng = random.Random(seed)
+    client = Client(port)
+    while time.perf_counter() < deadline:
+        for name, method, path, body in session(rng, regions, *dependencies):
+            if time.perf_counter() >= deadline:
+                return
+            try:
+                seconds = client.send(method, path, body)
+            except Exception as e:
+                if time.perf_counter() >= measureFrom:
+                    errors.append("%s: %s" % (name, e))
+                continue
+            if time.perf_counter() >= measureFrom:
+                timings.setdefault(name, []).append(seconds)
+            if think > 0:
+                time.sleep(rng.uniform(0, 2 * think))
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def workerPids(masterPid):
+    pids = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/%s/stat" % name) as f:
+                    # The parent pid follows the command name, which is in parentheses and can contain spaces
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == masterPid:
+                        pids.append(int(name))
+            except (OSError, ValueError, IndexError):
+                pass
+    return sorted(pids)
+
+
+# Sample the workers' memory every interval seconds until stop is set, keeping the peak of each
+def sampleMemory(masterPid, stop, peaks, interval=0.5):
+    while not stop.is_set():
+        for pid in workerPids(masterPid):
+            try:
+                pss, private = residentMemory(pid)
+            except OSError:
+                continue
+            previous = peaks.get(pid, (0, 0))
+            peaks[pid] = (max(previous[0], pss), max(previous[1], private))
+        stop.wait(interval)
+
+
+# Write the snapshot the workers boot from, built from synthetic files
+def writeSnapshot(args, snapshotDir):
+    paths = synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                      args.regions, args.counties, args.days)
+    synthetic.useJohnsFiles(paths)
+    data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+    manager = data_manager.DataManager(refresh_interval=0, shared=shared_snapshot.SharedSnapshot(
+        snapshotDir, data_manager.snapshotFormat))
+    return manager.refresh()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker")
+    parser.add_argument("--concurrency", type=int, default=4, help="simulated users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--think", type=float, default=0, help="mean seconds between a user's requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    snapshotDir = tempfile.mkdtemp(prefix="covid-nz-snapshot-")
+    snapshot = writeSnapshot(args, snapshotDir)
+    regions = list(snapshot.cases.columns)
+    del snapshot
+
+    port = freePort()
+    baseURL = "http://127.0.0.1:%d" % port
+    environment = dict(os.environ, SNAPSHOT_DIR=snapshotDir, DATA_REFRESH_INTERVAL="0",
+                       DATA_CACHE_DIR=tempfile.mkdtemp(prefix="covid-nz-cache-"))
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:server", "--bind", "127.0.0.1:%d" % port,
+                                "--workers", str(args.workers), "--threads", str(args.threads), "--timeout", "300"],
+                               cwd=repoDir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stop = threading.Event()
+    peaks = {}
+    try:
+        waitFor(baseURL + "/_dash-layout", process, args.timeout)
+        with urlopen(baseURL + "/_dash-dependencies") as response:
+            dependencies = json.load(response)
+        # The callback updating a tab's controls (update_tab, or update_store with clientside views) and the one
+        # creating a tab's content
+        tabDependency = next(d for d in dependencies if '"type":"dropdown"}.value' in d["output"] and
+                             any(specId(spec) == {"tab": ["ALL"], "type": "select_all"} for spec in d["inputs"]))
+        contentDependency = next(d for d in dependencies if d["output"] == "main_row.children")
+
+        sampler = threading.Thread(target=sampleMemory, args=(process.pid, stop, peaks), daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        measureFrom = start + args.warmup
+        deadline = measureFrom + args.duration
+        timings, errors = {}, []
+        users = [threading.Thread(target=user, args=(port, args.seed + i, regions,
+                                                      (tabDependency, contentDependency), args.think, measureFrom,
+                                                      deadline, timings, errors))
+                 for i in range(args.concurrency)]
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+    finally:
+        stop.set()
+        process.terminate()
+        process.wait()
+
+    requests = sum(len(values) for values in timings.values())
+    sessions = len(timings.get("GET /", []))
+    print("%d workers x %d threads, %d users, think %.1fs: %.1f requests/s, %.2f visits/s, %d errors" % (
+        args.workers, args.threads, args.concurrency, args.think, requests / args.duration,
+        sessions / args.duration, len(errors)))
+    print("%-32s %7s %9s %9s %9s" % ("request", "count", "p50 ms", "p95 ms", "p99 ms"))
+    latencies = {}
+    for name, values in sorted(timings.items()):
+        values.sort()
+        latencies[name] = dict(count=len(values), p50=percentile(values, 0.5), p95=percentile(values, 0.95),
+                               p99=percentile(values, 0.99))
+        print("%-32s %7d %9.1f %9.1f %9.1f" % (name, len(values), latencies[name]["p50"] * 1000,
+                                               latencies[name]["p95"] * 1000, latencies[name]["p99"] * 1000))
+    for pid, (pss, private) in sorted(peaks.items()):
+        print("worker %d: peak %.1f MB proportional, %.1f MB private" % (pid, pss / 1e6, private / 1e6))
+    print("workers: %.1f MB proportional in total" % (sum(pss for pss, private in peaks.values()) / 1e6))
+    for error in errors[:10]:
+        print("error:", error)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(parameters=vars(args), requests_per_second=requests / args.duration,
+                           visits_per_second=sessions / args.duration, errors=len(errors), latency=latencies,
+                           workers_mb={str(pid): dict(pss=pss / 1e6, private=private / 1e6)
+                                       for pid, (pss, private) in peaks.items()}), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import gc
+import multiprocessing
+import resource
+import tempfile
+import tracemalloc
+
+import data_fetch
+import data_manager
+import data_processing
+import shared_snapshot
+from benchmarks import synthetic
+
+# Memory held by one worker's data snapshot, loaded from synthetic files, and the memory of several workers with and
+# without the shared snapshot.
+# Run from the repository root: python -m benchmarks.bench_memory
+
+
+# Memory still allocated once the snapshot is built, rather than the peak while building it
+def loadSnapshot():
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = data_manager.createSnapshot(*data_processing.getData())
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return snapshot, retained
+
+
+# Proportional (shared pages split between the processes using them) and private resident memory of a process, this
+# one by default
+def residentMemory(pid="self"):
+    values = {}
+    with open("/proc/%s/smaps_rollup" % pid) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return values["Pss"], values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+
+
+# Load a snapshot the way a worker does and read every value of it, then report its memory
+def worker(shared, ready, done, results):
+    manager = data_manager.DataManager(refresh_interval=0, shared=shared)
+    snapshot = manager.get() if shared is not None else data_manager.createSnapshot(*data_processing.getData())
+    for frame in [snapshot.cases, snapshot.casesNew, snapshot.deaths, snapshot.deathsNew, snapshot.casesCounties,
+                  snapshot.deathsCounties, snapshot.derived.casesPerCapita, snapshot.derived.casesNew7Day, snapshot.derived.deathsPerCapita]:
+        frame.sum()
+    gc.collect()
+    ready.wait()
+    results.put(residentMemory())
+    done.wait()
+
+
+# Total proportional memory and the private memory of each of workers processes
+def workersMemory(workers, shared):
+    context = multiprocessing.get_context("fork")
+    ready, done, results = context.Barrier(workers + 1), context.Event(), context.Queue()
+    processes = [context.Process(target=worker, args=(shared, ready, done, results)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    ready.wait()
+    memory = [results.get() for i in range(workers)]
+    done.set()
+    for process in processes:
+        process.join()
+    return sum(pss for pss, private in memory), max(private for pss, private in memory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    paths = synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                      args.regions, args.counties, args.days)
+    synthetic.useJohnsFiles(paths)
+    data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+
+    snapshot, retained = loadSnapshot()
+    print("snapshot %d days x %d regions: %.1f MB retained, max RSS %.1f MB" % (
+        len(snapshot.cases), len(snapshot.cases.columns), retained / 1e6,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+
+    shared = shared_snapshot.SharedSnapshot(tempfile.mkdtemp(prefix="covid-nz-snapshot-"), data_manager.snapshotFormat)
+    shared.write(snapshot.version, snapshot.loadedAt, data_manager.snapshotFields(snapshot))
+    del snapshot
+    gc.collect()
+    for workers in args.workers:
+        for name, store in [("private", None), ("shared", shared)]:
+            pss, private = workersMemory(workers, store)
+            print("%d workers, %s snapshots: %.1f MB in total (PSS), %.1f MB private per worker" % (
+                workers, name, pss / 1e6, private / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+import data_processing
+from benchmarks import synthetic
+
+# Compare the typed parser in data_processing with the transpose based parser it replaced, on a synthetic US file.
+# Run from the repository root: python -m benchmarks.bench_parse
+
+
+# The parser before the typed path, kept here as the reference
+def transposeParse(path, grouping_column):
+    df = pd.read_csv(path)
+    df = df.T
+    df.columns = df.loc[grouping_column].values
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        df.index = pd.to_datetime(df.index, errors="coerce")
+        df = df.loc[df.index.dropna()]
+        return df.groupby(df.columns, axis=1).sum()
+
+
+# Time without tracing (tracemalloc slows down allocation heavy code), then run again for the peak memory
+def measure(parse, *args):
+    start = time.perf_counter()
+    parse(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    df = parse(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="covid-nz-fixtures-"), synthetic.fileNames["casesUS"])
+    synthetic.usFrame(args.counties, args.days).to_csv(path, index=False)
+    print("%d counties x %d days, %.1f MB" % (args.counties, args.days, os.path.getsize(path) / 1e6))
+
+    before, beforeTime, beforePeak = measure(transposeParse, path, "Province_State")
+    after, afterTime, afterPeak = measure(data_processing.parseJohnsData, path, "Province_State")
+
+    for name, df, elapsed, peak in [("transpose", before, beforeTime, beforePeak),
+                                    ("typed", after, afterTime, afterPeak)]:
+        print("%-10s parse %.2fs, peak memory %.1f MB, result %.2f MB %s" % (
+            name, elapsed, peak / 1e6, df.memory_usage(deep=True).sum() / 1e6, df.dtypes.iloc[0]))
+    print("results equal:", before.astype("int64").equals(after.astype("int64")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import data_fetch
+from benchmarks import synthetic
+from benchmarks.bench_suite import tabRequest
+
+# Size and build time of the tab callback's response with every region of the cases tab selected, with the figure
+# sent as JSON lists or as binary typed arrays.
+# Run from the repository root: python -m benchmarks.bench_payload
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--scale", default="linear")
+    parser.add_argument("--no-downsample", action="store_true")
+    args = parser.parse_args()
+
+    synthetic.useJohnsFiles(synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                                      args.regions, args.counties, args.days))
+    data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+    # Not the app's own processed snapshot
+    os.environ["SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="covid-nz-snapshot-")
+
+    import app
+    import downsampling
+    import figure_encoding
+    downsampling.downsampleEnabled = not args.no_downsample
+    client = app.server.test_client()
+    regions = list(app.dataManager.get().cases.columns)
+    # The tab callback's request with every region selected
+    request = tabRequest(app, "cases", regions, "total", args.scale)
+
+    for binary in [False, True]:
+        figure_encoding.binaryFigures = binary
+        app.figureCache.clear()
+        start = time.perf_counter()
+        response = client.post("/_dash-update-component", json=request)
+        elapsed = time.perf_counter() - start
+        body = response.get_data()
+        compressed = client.post("/_dash-update-component", json=request, headers={"Accept-Encoding": "gzip"})
+        json.loads(body)
+        print("%-6s %d regions: %.2f MB, %.2f MB gzip (%s), %.2fs to build and serialise" % (
+            "binary" if binary else "json", len(regions), len(body) / 1e6,
+            len(compressed.get_data()) / 1e6, compressed.headers.get("Content-Encoding"), elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import os
+import tempfile
+
+import data_fetch
+from benchmarks import synthetic
+from benchmarks.bench_startup import outputSpecs, specKey
+
+# Number of _dash-update-component requests each interaction costs, worked out from the app's /_dash-dependencies:
+# the server callbacks that have the changed control as an input, those that have their outputs as inputs, and so on.
+# Replacing the tab content creates new controls, whose callbacks make their initial call. Clientside callbacks
+# are counted apart as they make no request. Pass --clientside to count with CLIENTSIDE_VIEWS=1.
+# Run from the repository root: python -m benchmarks.bench_requests
+
+# Controls a user changes, as (type or id, property)
+interactions = [("dropdown", "value"), ("new_v_total", "value"), ("scale", "value"), ("threshold", "value"),
+                ("select_all", "n_clicks"), ("select_none", "n_clicks"), ("graph", "relayoutData"),
+                ("tab_selector", "value")]
+
+# The container the tab's controls are created in
+tabContent = ("main_row", "children")
+
+
+def inputKeys(dependency):
+    return {(specKey(spec), spec["property"]) for spec in dependency["inputs"]}
+
+
+# Server requests and clientside calls made after changed. Each callback runs at most once, as Dash runs a callback
+# once for all of its inputs that change together.
+def countCallbacks(dependencies, changed):
+    run = set()
+    counts = dict(server=0, clientside=0)
+
+    def trigger(i):
+        run.add(i)
+        counts["clientside" if dependencies[i].get("clientside_function") else "server"] += 1
+        for output in outputSpecs(dependencies[i]):
+            if (output["id"], output["property"]) == tabContent:
+                for j, dependency in enumerate(dependencies):
+                    if j not in run and not dependency.get("prevent_initial_call") and \
+                            any(spec["id"].startswith("{") for spec in dependency["inputs"]):
+                        trigger(j)
+            else:
+                changedBy((specKey(output), output["property"]))
+
+    def changedBy(key):
+        for i, dependency in enumerate(dependencies):
+            if i not in run and key in inputKeys(dependency):
+                trigger(i)
+
+    changedBy(changed)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clientside", action="store_true", help="count with clientside views")
+    args = parser.parse_args()
+
+    # The data is loaded when the app is imported
+    synthetic.useJohnsFiles(synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"), 10, 10, 30))
+    data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+    os.environ["SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="covid-nz-snapshot-")
+    os.environ["CLIENTSIDE_VIEWS"] = "1" if args.clientside else "0"
+
+    import app
+    client = app.server.test_client()
+    # Dash sets up its routes on the first request for the page
+    client.get("/")
+    dependencies = client.get("/_dash-dependencies").get_json()
+    for type, property in interactions:
+        counts = countCallbacks(dependencies, (type, property))
+        print("%-25s %d requests, %d clientside calls" % (
+            "%s.%s" % (type, property), counts["server"], counts["clientside"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from benchmarks import synthetic
+
+# Time from starting a server process to its first successful responses, booting from synthetic files with nothing
+# cached ("cold") and from the processed snapshot the cold run left on disk ("snapshot").
+# Run from the repository root: python -m benchmarks.bench_startup
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the server process: arguments are the fixture paths as JSON and the port
+serverCode = """
+import json, sys, time
+start = time.perf_counter()
+from benchmarks import synthetic
+synthetic.useJohnsFiles(json.loads(sys.argv[1]))
+import app
+print("imported %f" % (time.perf_counter() - start), flush=True)
+app.server.run(host="127.0.0.1", port=int(sys.argv[2]), threaded=True)
+"""
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Poll until request succeeds, returning the time it did
+def waitFor(request, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with %d" % process.returncode)
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                response.read()
+                return time.perf_counter()
+        except (URLError, ConnectionError):
+            time.sleep(0.01)
+    raise RuntimeError("server not ready after %.0fs" % timeout)
+
+
+# Parse an output or input spec of /_dash-dependencies into its id (a dict for pattern matching ids) and property
+def specId(spec):
+    return json.loads(spec["id"]) if spec["id"].startswith("{") else spec["id"]
+
+
+# The type of a pattern matching id, or the id
+def specKey(spec):
+    id = specId(spec)
+    return id["type"] if isinstance(id, dict) else id
+
+
+def outputSpecs(dependency):
+    outputs = dependency["output"]
+    if outputs.startswith(".."):
+        outputs = outputs[2:-2].split("...")
+    else:
+        outputs = [outputs]
+    return [dict(id=output.rsplit(".", 1)[0], property=output.rsplit(".", 1)[1]) for output in outputs]
+
+
+# The first graph request the page makes for the default tab
+def firstGraphRequest(baseURL):
+    with urlopen(baseURL + "/_dash-dependencies") as response:
+        dependencies = json.load(response)
+    dependency = next(d for d in dependencies if "header.children" in d["output"] and "graph" in d["output"])
+
+    def ids(specs, value=False):
+        result = []
+        for spec in specs:
+            id = json.loads(spec["id"]) if spec["id"].startswith("{") else spec["id"]
+            if isinstance(id, dict):
+                # Pattern matching ids of the cases tab's controls, with their default values
+                id = dict(id, tab="cases")
+                item = dict(id=id, property=spec["property"])
+                if value:
+                    item["value"] = {"new_v_total": "total", "scale": "linear", "threshold": 100,
+                                     "dropdown": ["New Zealand"], "drill_down": [[], []]}.get(id["type"])
+                result.append([item])
+            else:
+                result.append(dict(id=id, property=spec["property"]))
+        return result
+
+    outputs = dependency["output"].strip(".").split("...")
+    outputs = [dict(id=o.rsplit(".", 1)[0], property=o.rsplit(".", 1)[1]) for o in outputs]
+    body = dict(output=dependency["output"], outputs=ids(outputs), inputs=ids(dependency["inputs"], value=True),
+                state=ids(dependency.get("state", []), value=True), changedPropIds=[])
+    return Request(baseURL + "/_dash-update-component", data=json.dumps(body).encode("utf-8"),
+                   headers={"Content-Type": "application/json"})
+
+
+def startServer(paths, environment, timeout):
+    port = freePort()
+    baseURL = "http://127.0.0.1:%d" % port
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", serverCode, json.dumps(paths), str(port)], cwd=repoDir,
+                               env=environment, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        imported = float(process.stdout.readline().split()[1])
+        ready = waitFor(baseURL + "/_dash-layout", process, timeout)
+        graph = waitFor(firstGraphRequest(baseURL), process, timeout)
+        return imported, ready - start, graph - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    paths = synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                      args.regions, args.counties, args.days)
+    environment = dict(os.environ, DATA_REFRESH_INTERVAL="0")
+
+    for mode in ["cold", "snapshot"]:
+        results = []
+        for run in range(args.runs):
+            # Snapshot runs use the cache the last cold run filled
+            if mode == "cold":
+                environment["DATA_CACHE_DIR"] = tempfile.mkdtemp(prefix="covid-nz-cache-")
+                environment["SNAPSHOT_DIR"] = os.path.join(environment["DATA_CACHE_DIR"], "snapshot")
+            results.append(startServer(paths, environment, args.timeout))
+        for name, position in [("import app", 0), ("first layout", 1), ("first graph", 2)]:
+            values = sorted(result[position] for result in results)
+            print("%-8s %-12s median %.2fs, min %.2fs" % (mode, name, values[len(values) // 2], values[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import data_fetch
+import data_processing
+from benchmarks import synthetic
+
+# Times and peak memory of ingestion, label creation and the graph and header callbacks, against synthetic files so
+# it runs offline. Results are written as JSON; pass an earlier file with --compare to see what changed.
+# Run from the repository root: python -m benchmarks.bench_suite --output results.json
+
+selections = [("1 region", 1), ("10 regions", 10), ("select all", None)]
+# US counties, whose derived series are computed when they are shown
+countySelections = [("1 county", 1), ("10 counties", 10)]
+views = [("cases total linear", "cases", "total", "linear"),
+         ("cases total log", "cases", "total", "log"),
+         ("cases total per_capita", "cases", "total", "per_capita"),
+         ("cases total aligned", "cases", "total", "aligned"),
+         ("cases new", "cases", "new", "linear"),
+         ("deaths total linear", "deaths", "total", "linear"),
+         ("newVsTotal", "newVsTotal", None, None)]
+
+
+# Median and minimum seconds of runs calls to func, and its peak traced memory from one more call (tracemalloc slows
+# down allocation heavy code, so it isn't on while timing). setup is called before every call and isn't timed.
+def measure(func, runs, setup=None):
+    times = []
+    for run in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    return dict(median=times[len(times) // 2], min=times[0], runs=runs, peak_mb=peak / 1e6)
+
+
+def freshStore():
+    data_fetch.snapshotStore = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+
+
+def ingestion(paths, runs):
+    results = {}
+    for name, (grouping_column, replacement_columns) in [("cases", ("Country/Region", {"US": "USA"})),
+                                                         ("casesUS", (data_processing.usGrouping, None))]:
+        # A full parse each time
+        results["readJohnsData " + name] = measure(
+            lambda: data_processing.readJohnsData(paths[name], grouping_column, replacement_columns,
+                                                  incremental=False), runs, setup=freshStore)
+    results["readJohnsPopulation deathsUS"] = measure(
+        lambda: data_processing.readJohnsPopulation(paths["deathsUS"], data_processing.usGrouping), runs,
+        setup=freshStore)
+    counties = data_processing.readJohnsData(paths["casesUS"], data_processing.usGrouping, incremental=False)
+    results["rollupCounts casesUS"] = measure(lambda: data_processing.rollupCounts(counties), runs)
+
+    results["getData"] = measure(data_processing.getData, runs, setup=freshStore)
+    # Again with the previous result, as the background refresh does
+    previous = data_processing.getData()
+    results["getData with previous"] = measure(lambda: data_processing.getData(previous), runs)
+    return results
+
+
+def labels(snapshot, runs):
+    return {
+        "createLabelIndex": measure(lambda: data_processing.createLabelIndex(snapshot.cases), runs),
+        "labelText all regions": measure(lambda: [data_processing.labelText(i, snapshot.casesLabels[i])
+                                                  for i in snapshot.cases.columns], runs),
+    }
+
+
+# Request body for the tab callback, as the page sends it when the dropdown changes
+def tabRequest(app, tab, regions, newvtotal, scale):
+    output = next(key for key in app.app.callback_map if "header.children" in key and "graph" in key)
+
+    def control(type, property, value=None, present=True):
+        return [dict(id=app.tabId(type, tab), property=property, value=value)] if present else []
+
+    timeTab = tab != "newVsTotal"
+    outputs = [[dict(id=app.tabId("dropdown", tab), property="value")],
+               [dict(id=app.tabId("dropdown", tab), property="options")],
+               [dict(id=app.tabId("drill_down", tab), property="data")],
+               [dict(id=app.tabId("zoom", tab), property="data")],
+               [dict(id=app.tabId("graph", tab), property="figure")],
+               [dict(id=app.tabId("scale", tab), property="options")] if timeTab else [],
+               dict(id="header", property="children")]
+    inputs = [control("dropdown", "value", regions), control("new_v_total", "value", newvtotal, timeTab),
+              control("scale", "value", scale, timeTab),
+              control("threshold", "value", app.defaultAlignThreshold, timeTab), control("select_all", "n_clicks"),
+              control("select_none", "n_clicks"), control("graph", "relayoutData")]
+    changed = json.dumps(app.tabId("dropdown", tab), sort_keys=True, separators=(",", ":")) + ".value"
+    state = [control("drill_down", "data", [[], []]), control("zoom", "data")]
+    return dict(output=output, outputs=outputs, inputs=inputs, state=state, changedPropIds=[changed])
+
+
+def callbacks(app, snapshot, runs):
+    client = app.server.test_client()
+    regions = list(snapshot.cases.columns)
+    ordered = ["New Zealand"] + [region for region in regions if region != "New Zealand"]
+    counties = list(snapshot.casesCounties.columns)
+    results = {}
+    for selectionName, count in selections + countySelections:
+        selected = (counties if selectionName in dict(countySelections) else ordered)[:count] if count is not None \
+            else regions
+        for viewName, tab, newvtotal, scale in views:
+            body = tabRequest(app, tab, selected, newvtotal, scale)
+
+            def call():
+                response = client.post("/_dash-update-component", json=body)
+                if response.status_code != 200:
+                    raise RuntimeError("%s: %d %s" % (viewName, response.status_code, response.data[:200]))
+
+            # Figures are cached; time building them
+            results["update_tab %s, %s" % (viewName, selectionName)] = measure(
+                call, runs, setup=app.figureCache.clear)
+        results["createHeader, %s" % selectionName] = measure(
+            lambda: app.createHeader("cases", selected[0], "total", snapshot), runs)
+    return results
+
+
+# Megabytes held by each frame of the snapshot
+def frameSizes(snapshot):
+    return {name: round(value.memory_usage(deep=True).sum() / 1e6, 2)
+            for name, value in snapshot._asdict().items() if isinstance(value, pd.DataFrame)}
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previousPath):
+    with open(previousPath) as f:
+        previous = json.load(f)["results"]
+    print("\n%-55s %10s %10s %8s" % ("compared with " + os.path.basename(previousPath), "before", "after", "ratio"))
+    for name, result in results.items():
+        if name in previous:
+            before, after = previous[name]["median"], result["median"]
+            print("%-55s %9.4fs %9.4fs %7.2fx" % (name, before, after, after / before if before else float("nan")))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--regions", type=int, default=280)
+    parser.add_argument("--counties", type=int, default=3300)
+    parser.add_argument("--days", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    paths = synthetic.writeJohnsFiles(tempfile.mkdtemp(prefix="covid-nz-fixtures-"),
+                                      args.regions, args.counties, args.days)
+    synthetic.useJohnsFiles(paths)
+    freshStore()
+    # The app loads the synthetic data into its own snapshot directory, when it is first asked for it
+    os.environ["SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="covid-nz-snapshot-")
+    os.environ["DATA_REFRESH_INTERVAL"] = "0"
+    os.environ["DATA_PRELOAD"] = "0"
+
+    results = ingestion(paths, args.runs)
+    import app
+    snapshot = app.dataManager.get()
+    results.update(labels(snapshot, args.runs))
+    results.update(callbacks(app, snapshot, args.runs))
+
+    for name, result in results.items():
+        print("%-55s median %8.4fs, min %8.4fs, peak %7.1f MB" % (
+            name, result["median"], result["min"], result["peak_mb"]))
+
+    output = dict(
+        commit=commit(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(),
+        parameters=dict(regions=args.regions, counties=args.counties, days=args.days, runs=args.runs,
+                        snapshot_regions=len(snapshot.cases.columns)),
+        max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3,
+        frame_mb=frameSizes(snapshot),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
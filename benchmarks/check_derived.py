@@ -0,0 +1,42 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+import data_processing
+import derived_series
+
+# Check the derived series for counts too large for the synthetic fixtures to reach. Counts are stored as int32 when
+# they fit, and 10000 * count overflows int32 from 2**31 / 10000 (about 214,748) up. Exits with 1 if any check fails.
+# Run from the repository root: python -m benchmarks.check_derived
+
+failures = []
+
+
+def check(condition, message):
+    print("%-4s %s" % ("ok" if condition else "FAIL", message))
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    dates = pd.date_range("2021-01-01", periods=4)
+    totals = np.array([[200000, 10], [300000, 20], [1000000, 30], [2000000000, 40]])
+    regions = ["Large", "Small"]
+    cases = pd.DataFrame(data_processing.compactCounts(totals), index=dates, columns=regions)
+    casesNew = cases.diff()
+    population = pd.DataFrame([[5000000, 1000]], index=["Population"], columns=regions)
+    check(cases.dtypes.eq(np.int32).all(), "counts are stored as int32")
+
+    expected = 10000 * totals.astype(float) / np.array([5000000, 1000])
+    series = derived_series.createDerivedSeries(cases, casesNew, cases, casesNew, population)
+    check(np.allclose(series.casesPerCapita.to_numpy(), expected), "per capita counts above 2**31 / 10000")
+    check(series.casesPerCapita.loc[dates[2], "Large"] == 2000, "1,000,000 cases in 5,000,000 is 2000 per 10,000")
+    check(series.casesLatest.loc["Large", "total"] == 2000000000, "latest total")
+    check(series.casesNew7Day.loc[dates[-1], "Large"] == 2000000000 - 200000, "rolling new count")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+
+import data_fetch
+from benchmarks import fixture_server
+
+# Check SnapshotStore against a local server: a first fetch downloads, a second is answered with 304, a changed file
+# is downloaded again, and once the server is stopped the stored copy is served as stale. Exits with 1 if any check
+# fails. Run from the repository root: python -m benchmarks.check_fetch
+
+failures = []
+
+
+def check(condition, message):
+    print("%-4s %s" % ("ok" if condition else "FAIL", message))
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    fixtureDir = tempfile.mkdtemp(prefix="covid-nz-fixtures-")
+    path = os.path.join(fixtureDir, "series.csv")
+    with open(path, "w") as f:
+        f.write("Country/Region,1/22/20\nNew Zealand,0\n")
+    server, baseURL = fixture_server.serve(fixtureDir)
+    url = baseURL + "series.csv"
+    store = data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-"))
+
+    try:
+        first = store.fetch(url)
+        check(first.changed and not first.stale and store.stats["misses"] == 1, "first fetch downloads")
+        with open(first.path) as stored, open(path) as served:
+            check(stored.read() == served.read(), "stored copy matches the served file")
+
+        second = store.fetch(url)
+        check(not second.changed and store.stats["hits"] == 1 and store.stats["misses"] == 1,
+              "unchanged file is answered with 304")
+        check(second.digest == first.digest and second.path == first.path, "304 returns the stored copy")
+
+        with open(path, "a") as f:
+            f.write("Australia,0\n")
+        # The ETag includes the modification time, make sure it moves even on coarse clocks
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        third = store.fetch(url)
+        check(third.changed and store.stats["misses"] == 2 and third.digest != first.digest,
+              "changed file is downloaded again")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stale = store.fetch(url)
+    check(stale.stale and not stale.changed and store.stats["stale"] == 1 and stale.digest == third.digest,
+          "stored copy is served once the server is stopped")
+
+    try:
+        data_fetch.SnapshotStore(tempfile.mkdtemp(prefix="covid-nz-cache-")).fetch(url)
+        check(False, "fetch with no stored copy raises FetchError")
+    except data_fetch.FetchError:
+        check(True, "fetch with no stored copy raises FetchError")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
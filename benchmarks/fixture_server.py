@@ -0,0 +1,52 @@
+import functools
+import hashlib
+import http.server
+import os
+import threading
+import time
+from email.utils import formatdate
+
+# Local stand-in for raw.githubusercontent.com serving files from a directory. Sends ETag and Last-Modified, answers
+# conditional requests with 304, and can add latency to each response to mimic a remote server.
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, latency=0.0, **kwargs):
+        self.latency = latency
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        time.sleep(self.latency)
+
+        stat = os.stat(path)
+        etag = '"%s"' % hashlib.sha1(("%s-%d-%d" % (path, stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        f = open(path, "rb")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        return f
+
+
+# Start a server for directory on a free port in a background thread. Returns (server, base url).
+def serve(directory, latency=0.0):
+    handler = functools.partial(FixtureHandler, directory=directory, latency=latency)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/" % server.server_port
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import data_processing
+
+# Synthetic Johns Hopkins time series files, so benchmarks can run offline at any size.
+# Values for each day are drawn from a generator seeded by (seed, day), so a file with more days is the same file
+# with columns appended, like the real data.
+
+fileNames = {
+    "cases": "time_series_covid19_confirmed_global.csv",
+    "deaths": "time_series_covid19_deaths_global.csv",
+    "casesUS": "time_series_covid19_confirmed_US.csv",
+    "deathsUS": "time_series_covid19_deaths_US.csv",
+}
+
+firstDate = pd.Timestamp("2020-01-22")
+
+dataDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def _dateColumns(days):
+    return ["%d/%d/%s" % (d.month, d.day, d.strftime("%y")) for d in pd.date_range(firstDate, periods=days)]
+
+
+# Cumulative counts for rows x days. Every row starts at zero and some start later than others.
+def _cumulative(rows, days, seed, scale):
+    daily = np.empty((rows, days), dtype=np.int64)
+    for day in range(days):
+        daily[:, day] = np.random.default_rng((seed, day)).poisson(scale, rows)
+    start = np.random.default_rng((seed, 1 << 20)).integers(0, 60, rows)
+    daily[np.arange(days)[None, :] < start[:, None]] = 0
+    return daily.cumsum(axis=1)
+
+
+# Countries that have population data (so per capita views work), then made up ones to reach regions.
+def _countries(regions):
+    population = pd.read_csv(os.path.join(dataDir, "population_data.csv"), header=4)
+    names = [name for name in population["Country Name"] if isinstance(name, str)]
+    # The US is called "USA" after its rename in getData
+    names = ["New Zealand", "US", "Australia"] + [name for name in names if name not in ("New Zealand", "Australia", "USA")]
+    names += ["Region %04d" % i for i in range(max(0, regions - len(names)))]
+    return names[:regions]
+
+
+def _states():
+    population = pd.read_csv(os.path.join(dataDir, "us_states_population.csv"), header=1)
+    return [name for name in population["NAME"] if "Region" not in name and name != "United States"]
+
+
+def globalFrame(regions=280, days=1000, seed=0, scale=50, provinces=3):
+    countries = _countries(regions)
+    # A few countries are split into provinces, like Australia, Canada and China in the real data
+    rows = []
+    for i, country in enumerate(countries):
+        if i < provinces:
+            rows += [("Province %d" % j, country) for j in range(4)]
+        else:
+            rows.append((None, country))
+    frame = pd.DataFrame(rows, columns=["Province/State", "Country/Region"])
+    frame["Lat"] = 0.0
+    frame["Long"] = 0.0
+    values = pd.DataFrame(_cumulative(len(rows), days, seed, scale), columns=_dateColumns(days))
+    return pd.concat([frame, values], axis=1)
+
+
+def usFrame(counties=3300, days=1000, seed=1, scale=5, deaths=False):
+    states = _states()
+    rows = [("County %d" % i, states[i % len(states)]) for i in range(counties)]
+    frame = pd.DataFrame(rows, columns=["Admin2", "Province_State"])
+    frame.insert(0, "UID", np.arange(84000000, 84000000 + counties))
+    frame.insert(1, "iso2", "US")
+    frame.insert(2, "iso3", "USA")
+    frame.insert(3, "code3", 840)
+    frame.insert(4, "FIPS", np.arange(1000, 1000 + counties, dtype=float))
+    frame["Country_Region"] = "US"
+    frame["Lat"] = 0.0
+    frame["Long_"] = 0.0
+    frame["Combined_Key"] = frame["Admin2"] + ", " + frame["Province_State"] + ", US"
+    if deaths:
+        frame["Population"] = 100000
+    values = pd.DataFrame(_cumulative(counties, days, seed, scale), columns=_dateColumns(days))
+    return pd.concat([frame, values], axis=1)
+
+
+# Write the four files to directory and return a dict of their paths, keyed like fileNames
+def writeJohnsFiles(directory, regions=280, counties=3300, days=1000, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    frames = {
+        "cases": globalFrame(regions, days, seed, scale=50),
+        "deaths": globalFrame(regions, days, seed, scale=1),
+        "casesUS": usFrame(counties, days, seed + 1, scale=5),
+        "deathsUS": usFrame(counties, days, seed + 1, scale=0.1, deaths=True),
+    }
+    paths = {}
+    for name, frame in frames.items():
+        paths[name] = os.path.join(directory, fileNames[name])
+        frame.to_csv(paths[name], index=False)
+    return paths
+
+
+# Point data_processing at the given files (paths or URLs, keyed like fileNames)
+def useJohnsFiles(paths):
+    data_processing.johnsURLTotal = paths["cases"]
+    data_processing.johnsURLDeaths = paths["deaths"]
+    data_processing.johnsURLTotalUS = paths["casesUS"]
+    data_processing.johnsURLDeathsUS = paths["deathsUS"]
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import pickle
+import socket
+import threading
+from collections import Counter, namedtuple
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+# Where the last good raw and parsed copies of each upstream file are kept
+cacheDir = os.environ.get("DATA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+# Seconds to wait for upstream before falling back to the stored copy
+fetchTimeout = float(os.environ.get("DATA_FETCH_TIMEOUT", 30))
+
+# path: local copy of the raw file. changed: whether it differs from the previous fetch.
+# stale: upstream could not be reached and the stored copy is being served instead.
+FetchResult = namedtuple("FetchResult", ["path", "digest", "changed", "stale"])
+
+
+class FetchError(Exception):
+    pass
+
+
+class SnapshotStore:
+    def __init__(self, cache_dir=cacheDir, timeout=fetchTimeout):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        # hits: upstream unchanged (304). misses: downloaded. stale: upstream failed, stored copy served.
+        # parsed_hits/parsed_misses: parsed copy reused or rebuilt
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _readMeta(self, key):
+        try:
+            with open(self._path(key + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # Write via a temporary file so other workers sharing the directory never read a partial file
+    def _writeAtomic(self, name, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = self._path("%s.%d.%d.tmp" % (name, os.getpid(), threading.get_ident()))
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    # Fetch url, sending the validators from the last successful download so unchanged files are not re-sent.
+    # Local file paths are returned as they are.
+    def fetch(self, url):
+        if not url.startswith(("http://", "https://")):
+            return FetchResult(url, None, True, False)
+
+        key = self._key(url)
+        rawPath = self._path(key + ".csv")
+        meta = self._readMeta(key)
+        if meta is not None and not os.path.exists(rawPath):
+            meta = None
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            with urlopen(Request(url, headers=headers), timeout=self.timeout) as response:
+                data = response.read()
+                newMeta = dict(url=url,
+                               etag=response.headers.get("ETag"),
+                               last_modified=response.headers.get("Last-Modified"),
+                               digest=hashlib.sha256(data).hexdigest())
+        except HTTPError as e:
+            if e.code == 304 and meta is not None:
+                self._count("hits")
+                return FetchResult(rawPath, meta["digest"], False, False)
+            return self._fallback(url, meta, rawPath, e)
+        except (URLError, OSError, socket.timeout) as e:
+            return self._fallback(url, meta, rawPath, e)
+
+        self._count("misses")
+        changed = meta is None or meta["digest"] != newMeta["digest"]
+        if changed:
+            self._writeAtomic(key + ".csv", data)
+        self._writeAtomic(key + ".json", json.dumps(newMeta).encode("utf-8"))
+        return FetchResult(rawPath, newMeta["digest"], changed, False)
+
+    def _fallback(self, url, meta, rawPath, error):
+        self._count("errors")
+        if meta is None:
+            raise FetchError("Could not fetch %s and no stored copy is available: %s" % (url, error))
+        print("Error fetching %s, serving stored copy:" % url, error)
+        self._count("stale")
+        return FetchResult(rawPath, meta["digest"], False, True)
+
+    # Parsed copies are tied to the digest of the raw file they were built from and a variant describing how it
+    # was parsed
+    def _parsedName(self, url, variant, digest):
+        return "%s-%s-%s.pkl" % (self._key(url), hashlib.sha1(variant.encode("utf-8")).hexdigest()[:8], digest[:16])
+
+    def loadParsed(self, url, variant, digest):
+        if digest is None:
+            return None
+        try:
+            with open(self._path(self._parsedName(url, variant, digest)), "rb") as f:
+                df = pickle.load(f)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            self._count("parsed_misses")
+            return None
+        self._count("parsed_hits")
+        return df
+
+    # Most recent parsed copy for url and variant whatever raw file it was built from, used as the base for
+    # incremental ingestion
+    def loadLatestParsed(self, url, variant):
+        prefix = self._parsedName(url, variant, "").rsplit("-", 1)[0]
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if name.startswith(prefix) and name.endswith(".pkl")]
+        except OSError:
+            return None
+        for name in names:
+            try:
+                with open(self._path(name), "rb") as f:
+                    return pickle.load(f)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass
+        return None
+
+    def saveParsed(self, url, variant, digest, df):
+        if digest is None:
+            return
+        name = self._parsedName(url, variant, digest)
+        prefix = name.rsplit("-", 1)[0]
+        self._writeAtomic(name, pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+        # Remove copies parsed from older versions of the file
+        for other in os.listdir(self.cache_dir):
+            if other.startswith(prefix) and other.endswith(".pkl") and other != name:
+                try:
+                    os.remove(self._path(other))
+                except OSError:
+                    pass
+
+
+snapshotStore = SnapshotStore()
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+import pandas as pd
+
+import data_processing
+import derived_series
+import metrics
+import shared_snapshot
+
+# Seconds between background refreshes of the Johns Hopkins data
+refreshInterval = float(os.environ.get("DATA_REFRESH_INTERVAL", 60 * 60))
+# Seconds between checks for a snapshot written by another worker
+snapshotCheckInterval = float(os.environ.get("SNAPSHOT_CHECK_INTERVAL", 30))
+
+# Everything the callbacks read, loaded together so a request never sees a mix of old and new frames.
+# Snapshots are never modified after they are published; a refresh builds a new one and swaps the reference.
+# The first fields are those returned by the loader. cases and deaths hold countries and US states; US counties are
+# kept apart in casesCounties and deathsCounties (their derived series are computed when they are shown), and regions
+# is the regions.createRegionTable hierarchy of all three.
+loadedFields = ["cases", "casesLabels", "casesNew", "deaths", "deathsLabels", "deathsNew", "population",
+                "casesCounties", "deathsCounties", "regions"]
+Snapshot = namedtuple("Snapshot", loadedFields + ["derived", "version", "loadedAt"])
+
+# Fields stored by shared_snapshot
+storedFields = loadedFields + list(derived_series.DerivedSeries._fields)
+# Changes with the fields stored and the parameters of the derived series, so a shared snapshot written by a build of
+# the app that derived them differently is never mapped (the data, and so the version, may not have changed since)
+snapshotFormat = hashlib.sha1(repr((storedFields, derived_series.logThreshold, derived_series.rollingDays,
+                                     derived_series.alignThresholds)).encode("utf-8")).hexdigest()[:12]
+
+
+def createSnapshot(cases, casesLabels, casesNew, deaths, deathsLabels, deathsNew, population, casesCounties,
+                   deathsCounties, regions):
+    # Version is derived from the content so it is the same in every worker and only changes with the data
+    version = hashlib.sha1(pd.util.hash_pandas_object(cases.T, index=True).to_numpy().tobytes() +
+                           pd.util.hash_pandas_object(deaths.T, index=True).to_numpy().tobytes()).hexdigest()[:16]
+    with metrics.timed("derive"):
+        derived = derived_series.createDerivedSeries(cases, casesNew, deaths, deathsNew, population)
+    return Snapshot(cases, casesLabels, casesNew, deaths, deathsLabels, deathsNew, population, casesCounties,
+                    deathsCounties, regions, derived, version, time.time())
+
+
+class DataManager:
+    def __init__(self, loader=data_processing.getData, refresh_interval=refreshInterval, shared=None,
+                 check_interval=snapshotCheckInterval):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        # Snapshots are shared with other workers through this (a shared_snapshot.SharedSnapshot) unless it is None
+        if shared is None and shared_snapshot.sharedSnapshots:
+            shared = shared_snapshot.SharedSnapshot(format=snapshotFormat)
+        self.shared = shared
+        self._snapshot = None
+        self._loadLock = threading.Lock()
+        # Held while refreshing, so only one refresh runs at a time in this worker
+        self._refreshLock = threading.Lock()
+        self._thread = None
+        self.last_refresh_duration = None
+        # Called with the new snapshot whenever the data changes
+        self.listeners = []
+        # Threads don't survive a fork, and a lock held by one of them would never be released in the child
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._afterFork)
+
+    # Return the current snapshot, loading it on first use. Cheap after the first call.
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._loadLock:
+                if self._snapshot is None:
+                    # A snapshot written by another worker (or an earlier run) is used without going to the network.
+                    # It is refreshed in the background if it is older than the refresh interval.
+                    try:
+                        current = self.remap()
+                    except Exception as e:
+                        print("Error loading shared snapshot:", e)
+                        current = None
+                    if current is None:
+                        self.refresh()
+            snapshot = self._snapshot
+        self.start()
+        return snapshot
+
+    # Load a new snapshot and publish it. Assigning the reference is atomic, so readers see either the old or the
+    # new snapshot in full. Only one refresh runs at a time, across workers too when the snapshot is shared: a caller
+    # that arrives during another refresh waits for it and gets its snapshot instead of loading the data again.
+    def refresh(self):
+        requested = time.time()
+        waitStart = time.perf_counter()
+        with self._refreshLock, self._workerLock():
+            metrics.refreshWaitSeconds.observe(time.perf_counter() - waitStart)
+            self.remap()
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.loadedAt >= requested:
+                metrics.refreshes.inc(result="coalesced")
+                return snapshot
+
+            start = time.perf_counter()
+            previous = self._snapshot
+            snapshot = createSnapshot(*self.loader(previous[:len(loadedFields)] if previous is not None else None))
+            if self.shared is not None:
+                # Serve the shared copy so this worker doesn't keep a private one
+                self.shared.write(snapshot.version, snapshot.loadedAt, snapshotFields(snapshot))
+                snapshot = fieldsSnapshot(self.shared.load(snapshot.version), snapshot.version, snapshot.loadedAt)
+            self._publish(snapshot)
+            self.last_refresh_duration = time.perf_counter() - start
+            metrics.refreshSeconds.observe(self.last_refresh_duration)
+            metrics.refreshes.inc(result="loaded")
+            return snapshot
+
+    # Lock held by the worker refreshing the shared snapshot
+    def _workerLock(self):
+        return self.shared.lock() if self.shared is not None else nullcontext()
+
+    # Seconds since the current snapshot was loaded, or None before it is
+    def age(self):
+        snapshot = self._snapshot
+        return time.time() - snapshot.loadedAt if snapshot is not None else None
+
+    # Switch to the shared snapshot if another worker has written a newer one. Returns the shared snapshot's
+    # details, or None if there isn't one this version of the app can read.
+    def remap(self):
+        if self.shared is None:
+            return None
+        current = self.shared.current()
+        if current is None:
+            return None
+        previous = self._snapshot
+        if previous is None or previous.version != current["version"]:
+            fields = self.shared.load(current["version"])
+            self._publish(fieldsSnapshot(fields, current["version"], current["loadedAt"]))
+        elif previous.loadedAt != current["loadedAt"]:
+            self._snapshot = previous._replace(loadedAt=current["loadedAt"])
+        return current
+
+    def _publish(self, snapshot):
+        previous = self._snapshot
+        self._snapshot = snapshot
+        if previous is None or previous.version != snapshot.version:
+            for listener in self.listeners:
+                listener(snapshot)
+
+    # Load the snapshot in the background, so it is ready (or being loaded) when the first request arrives
+    def preload(self):
+        threading.Thread(target=self._preload, name="data-preload", daemon=True).start()
+
+    def _preload(self):
+        try:
+            self.get()
+        except Exception as e:
+            # The first request tries again
+            print("Error preloading data:", e)
+
+    def _afterFork(self):
+        self._loadLock = threading.Lock()
+        self._refreshLock = threading.Lock()
+        self._thread = None
+
+    # Start the background refresh thread. Started lazily so it is created in the process that serves requests
+    # (gunicorn forks workers after importing the app)
+    def start(self):
+        if self._thread is not None or self.refresh_interval <= 0:
+            return
+        with self._loadLock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refreshLoop, name="data-refresh", daemon=True)
+                self._thread.start()
+
+    # Refresh once the snapshot is refresh_interval old. With a shared snapshot, check for one written by another
+    # worker every check_interval in between, and only refresh if no worker has done it recently.
+    def _refreshLoop(self):
+        while True:
+            interval = self.refresh_interval if self.shared is None else min(self.refresh_interval,
+                                                                             self.check_interval)
+            time.sleep(interval)
+            try:
+                self.remap()
+                if self.shared is None or time.time() - self._snapshot.loadedAt >= self.refresh_interval:
+                    self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot
+                metrics.refreshErrors.inc()
+                print("Error refreshing data:", e)
+
+
+# Flatten snapshot into the fields stored by shared_snapshot
+def snapshotFields(snapshot):
+    fields = snapshot._asdict()
+    for name in ["derived", "version", "loadedAt"]:
+        del fields[name]
+    fields.update(snapshot.derived._asdict())
+    return fields
+
+
+def fieldsSnapshot(fields, version, loadedAt):
+    derived = derived_series.DerivedSeries(**{name: fields[name] for name in derived_series.DerivedSeries._fields})
+    return Snapshot(derived=derived, version=version, loadedAt=loadedAt,
+                    **{name: fields[name] for name in Snapshot._fields if name not in ["derived", "version", "loadedAt"]})
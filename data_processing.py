@@ -1,9 +1,13 @@
 import pandas as pd
 from datetime import datetime
 import numpy as np
-from bs4 import BeautifulSoup
-from urllib.request import urlopen
 import locale
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import data_fetch
+import metrics
+import regions as region_table
 pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
@@ -14,16 +18,48 @@ johnsURLDeaths = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_cov
 johnsURLTotalUS = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv"
 johnsURLDeathsUS = "https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv"
 
+# Only parse the date columns added since the last ingest instead of the whole file
+incrementalIngest = os.environ.get("DATA_INCREMENTAL", "1") == "1"
+# Days already ingested that are parsed again with the new ones. If any of them has been revised upstream, the whole
+# file is parsed again
+revisionDays = int(os.environ.get("DATA_REVISION_DAYS", 14))
+# Revisions to older days are picked up by parsing the whole file once every this many days of data (when a new date
+# is a multiple of it since 1970), 0 to never do it
+fullParseDays = int(os.environ.get("DATA_FULL_PARSE_DAYS", 7))
+
+# Number of Johns Hopkins files fetched and parsed at the same time, and seconds allowed for each one
+fetchWorkers = int(os.environ.get("DATA_FETCH_WORKERS", 4))
+sourceTimeout = float(os.environ.get("DATA_SOURCE_TIMEOUT", 120))
+
+# US files are read at county level. States are summed from their counties rather than read separately
+usGrouping = ["Province_State", "Admin2"]
+
 mohURL = "https://www.health.govt.nz/our-work/diseases-and-conditions/covid-19-novel-coronavirus/covid-19-current-situation/covid-19-current-cases"
 
 
-def getData():
+# previous is the result of the last call, if any. When days have only been appended since then, the daily new frames
+# are extended rather than rebuilt
+def getData(previous=None):
     # Get Johns Hopkins Data
-    cases = readJohnsData(johnsURLTotal, "Country/Region", {"US":"USA"})
-    deaths = readJohnsData(johnsURLDeaths, "Country/Region", {"US":"USA"})
+    johns = readAllJohnsData({
+        "cases": (johnsURLTotal, "Country/Region", {"US":"USA"}),
+        "deaths": (johnsURLDeaths, "Country/Region", {"US":"USA"}),
+        "casesUS": (johnsURLTotalUS, usGrouping),
+        # County population is only in the deaths file, and is read from the same download
+        "deathsUS": (readJohnsDataAndPopulation, johnsURLDeathsUS, usGrouping),
+    })
+    johns["deathsUS"], countyPopulation = johns["deathsUS"]
+    start = time.perf_counter()
+    cases, deaths = johns["cases"], johns["deaths"]
+    countries = cases.columns
 
-    casesUS = readJohnsData(johnsURLTotalUS, "Province_State").add_suffix(", USA")
-    deathsUS = readJohnsData(johnsURLDeathsUS, "Province_State").add_suffix(", USA")
+    casesUS = rollupCounts(johns["casesUS"]).add_suffix(", USA")
+    deathsUS = rollupCounts(johns["deathsUS"]).add_suffix(", USA")
+    casesCounties = region_table.countyColumns(johns["casesUS"])
+    deathsCounties = region_table.countyColumns(johns["deathsUS"])
+    usRegions = johns["casesUS"].columns
+    regionTable = region_table.createRegionTable(countries, usRegions.get_level_values(0).unique(),
+                                                 usRegions[usRegions.get_level_values(1) != ""])
 
 
     # There is no recovered data for US, therefore US data is added after calculating active so US states do not appear in active
@@ -34,6 +70,9 @@ def getData():
     #   Turning this off for now as we are running into inconsistencies due to time zones
     #
     # # Check Ministry of Health website for latest total and concat with df.
+    # # Imported here so the app doesn't pay for BeautifulSoup at startup while the scraper is off
+    # from bs4 import BeautifulSoup
+    # from urllib.request import urlopen
     # try:
     #     mohHTML = urlopen(mohURL).read().decode('utf-8')
     #     soup = BeautifulSoup(mohHTML,'html.parser')
@@ -61,52 +100,238 @@ def getData():
     us_pop.drop(us_pop.index[0])
     us_pop = us_pop.add_suffix(", USA")
 
-    population = pd.concat([population,us_pop],axis=1)
+    countyPopulation = countyPopulation[countyPopulation.index.get_level_values(1) != ""]
+    countyPopulation = pd.DataFrame([countyPopulation.to_numpy()], index=["Population"],
+                                    columns=region_table.countyNames(countyPopulation.index))
 
+    population = pd.concat([population,us_pop,countyPopulation],axis=1)
 
-    # Create text for graph. Name of country at the end, the rest blank
-    # Also Create text for other dataframes (can be different as we don't get extra data for NZ deaths yet)
-    casesText = createTextForGraph(cases)
-    deathsText = createTextForGraph(deaths)
 
+    # Rows to put each region's name next to on the graph. The text itself is built when a figure is drawn
+    # Separate for deaths (can be different as we don't get extra data for NZ deaths yet)
+    casesLabels = createLabelIndex(cases)
+    deathsLabels = createLabelIndex(deaths)
 
     # Calculate daily new
-    casesNew = cases - cases.shift()
-    deathsNew = deaths - deaths.shift()
+    if previous is not None:
+        prevCases, prevCasesLabels, prevCasesNew, prevDeaths, prevDeathsLabels, prevDeathsNew = previous[:6]
+        casesNew = extendNew(cases, prevCases, prevCasesNew)
+        deathsNew = extendNew(deaths, prevDeaths, prevDeathsNew)
+    else:
+        casesNew = cases - cases.shift()
+        deathsNew = deaths - deaths.shift()
+
+    metrics.observeStage("aggregate", time.perf_counter() - start)
+    return cases,casesLabels,casesNew,deaths, deathsLabels, deathsNew, population, casesCounties, deathsCounties, regionTable
+
 
+# Totals of the outer regions of a frame read with a list of grouping columns, summed from the inner regions
+def rollupCounts(df):
+    totals = region_table.rollup(df)
+    return pd.DataFrame(compactCounts(totals.to_numpy()), index=totals.index, columns=totals.columns)
 
-    return cases,casesText,casesNew,deaths, deathsText, deathsNew, population
 
+# Position of the row each region's name goes on in the graph: the last row, or the one before if the last row is
+# empty for that region
+def createLabelIndex(df):
+    return pd.Series(np.where(df.iloc[-1].isna().to_numpy(), len(df) - 2, len(df) - 1), index=df.columns)
 
-# Create text for graph. Name of country at the end, the rest blank
-def createTextForGraph(df):
-    dfText = df.copy()
-    nacols = dfText.columns[dfText.iloc[-1].isna()]
-    notnacols = dfText.columns[dfText.iloc[-1].notna()]
 
-    dfText.loc[dfText.index[-1], notnacols] = notnacols
-    dfText.loc[dfText.index[:-1], notnacols] = ""
+# Text for a trace of the rows from start up to the label. Name of country at the end, the rest blank
+def labelText(label, position, start=0):
+    if position < start:
+        return []
+    return [""] * (position - start) + [label]
 
-    dfText.loc[dfText.index[-2], nacols] = nacols
-    dfText.loc[dfText.index[:-2], nacols] = ""
 
-    return dfText
+# Read several Johns Hopkins files concurrently. sources maps a name to the arguments for readJohnsData, or to
+# another reader function followed by its arguments. The time each source takes is recorded in metrics.sourceSeconds.
+# Raises if any source fails or takes longer than timeout seconds to read.
+def readAllJohnsData(sources, workers=None, timeout=None):
+    workers = fetchWorkers if workers is None else workers
+    timeout = sourceTimeout if timeout is None else timeout
 
+    def timedRead(name, args):
+        start = time.perf_counter()
+        df = args[0](*args[1:]) if callable(args[0]) else readJohnsData(*args)
+        metrics.sourceSeconds.observe(time.perf_counter() - start, source=name)
+        return df
 
-def readJohnsData(url, grouping_column, replacement_columns=None):
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="johns")
     try:
-        df = pd.read_csv(url)
-    except Exception as e:
+        start = time.perf_counter()
+        # Sources queued behind others when there are fewer workers than sources get extra time
+        deadline = start + timeout * -(-len(sources) // max(1, workers))
+        futures = {name: pool.submit(timedRead, name, args) for name, args in sources.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.perf_counter()))
+            except TimeoutError:
+                raise TimeoutError("Timed out after %gs reading Johns Hopkins source %s" % (timeout, name))
+    finally:
+        # Don't wait on a source that has timed out
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+# Daily new frame for df, extending the one built for previous if df only has rows appended to it
+def extendNew(df, previous, previousNew):
+    n = len(previous)
+    if n < 1 or len(df) < n or not df.columns.equals(previous.columns) or not df.iloc[:n].equals(previous):
+        return df - df.shift()
+    if len(df) == n:
+        return previousNew
+
+    tail = df.iloc[n - 1:]
+    return pd.concat([previousNew, (tail - tail.shift()).iloc[1:]])
+
+
+def readJohnsData(url, grouping_column, replacement_columns=None, store=None, incremental=None):
+    store = store if store is not None else data_fetch.snapshotStore
+    return johnsCounts(fetchJohnsData(url, store), url, grouping_column, replacement_columns, store, incremental)
+
+
+# Population column of a Johns Hopkins file (only the US deaths file has one), summed by region like the counts
+def readJohnsPopulation(url, grouping_column, store=None):
+    store = store if store is not None else data_fetch.snapshotStore
+    return johnsPopulation(fetchJohnsData(url, store), url, grouping_column, store)
+
+
+# The counts and the population of a file with a Population column, from one fetch
+def readJohnsDataAndPopulation(url, grouping_column, store=None, incremental=None):
+    store = store if store is not None else data_fetch.snapshotStore
+    result = fetchJohnsData(url, store)
+    return (johnsCounts(result, url, grouping_column, None, store, incremental),
+            johnsPopulation(result, url, grouping_column, store))
+
+
+def fetchJohnsData(url, store):
+    try:
+        with metrics.timed("fetch"):
+            return store.fetch(url)
+    except data_fetch.FetchError as e:
         print("Error getting data from Johns Hopkins Github:", e)
-        exit(1)
+        raise
+
 
-    df = df.T
-    df.columns = df.loc[grouping_column].values
-    df.index = pd.to_datetime(df.index, errors="coerce")
-    df = df.loc[df.index.dropna()]
-    df = df.groupby(df.columns, axis=1).sum()
+# Counts of the fetched file result
+def johnsCounts(result, url, grouping_column, replacement_columns, store, incremental=None):
+    incremental = incrementalIngest if incremental is None else incremental
+
+    # Reuse the parsed copy if the raw file hasn't changed since it was built
+    variant = repr((grouping_column, sorted((replacement_columns or {}).items())))
+    if not result.changed:
+        df = store.loadParsed(url, variant, result.digest)
+        if df is not None:
+            return df
+
+    with metrics.timed("parse"):
+        df = None
+        if incremental:
+            previous = store.loadLatestParsed(url, variant)
+            if previous is not None:
+                df = parseNewJohnsData(result.path, previous, grouping_column, replacement_columns)
+        if df is None:
+            df = parseJohnsData(result.path, grouping_column, replacement_columns)
+    store.saveParsed(url, variant, result.digest, df)
+    return df
+
+
+# Population of the fetched file result
+def johnsPopulation(result, url, grouping_column, store):
+    variant = repr((grouping_column, "Population"))
+    if not result.changed:
+        population = store.loadParsed(url, variant, result.digest)
+        if population is not None:
+            return population
+
+    with metrics.timed("parse"):
+        grouping = grouping_column if isinstance(grouping_column, list) else [grouping_column]
+        df = pd.read_csv(result.path, usecols=[*grouping, "Population"])
+        df[grouping] = df[grouping].fillna("")
+        population = df.groupby(grouping_column)["Population"].sum()
+    store.saveParsed(url, variant, result.digest, population)
+    return population
+
+
+def parseJohnsData(path, grouping_column, replacement_columns=None):
+    columns, dates = readJohnsDates(path)
+    return aggregateJohnsData(path, grouping_column, columns, dates, replacement_columns)
+
+
+# Parse only the date columns after the last date in previous, and the last revisionDays before them to check that
+# they are unchanged, and append the new ones. Returns None if the file can't be treated as an append (no new dates
+# means existing values were revised, the checked days were revised, or the set of regions has changed) or a full
+# parse is due (see fullParseDays), in which case the whole file should be parsed again.
+def parseNewJohnsData(path, previous, grouping_column, replacement_columns=None):
+    columns, dates = readJohnsDates(path)
+    isNew = dates > previous.index[-1]
+    if not isNew.any():
+        return None
+    if fullParseDays > 0 and (dates[isNew].asi8 // pd.Timedelta(days=1).value % fullParseDays == 0).any():
+        return None
+    checked = previous.index[len(previous) - min(revisionDays, len(previous)):]
+    isChecked = dates.isin(checked)
+    if isChecked.sum() != len(checked):
+        return None
+
+    read = isNew | isChecked
+    df = aggregateJohnsData(path, grouping_column, columns[read], dates[read], replacement_columns)
+
+    if len(df.columns) != len(previous.columns) or not df.columns.isin(previous.columns).all():
+        return None
+    df = df[previous.columns]
+    if not np.array_equal(df.loc[checked].to_numpy(), previous.loc[checked].to_numpy()):
+        return None
+
+    return pd.concat([previous, df.loc[dates[isNew]]])
+
+
+# The date columns of a Johns Hopkins file and the dates they hold, read from the header only
+def readJohnsDates(path):
+    header = pd.read_csv(path, nrows=0).columns
+    dates = pd.to_datetime(header, format="%m/%d/%y", errors="coerce")
+    return header[dates.notna()], dates[dates.notna()]
+
+
+# Sum the given date columns by region as numbers and return a dates x regions frame. Only the grouping column and
+# the date columns are read, so the text columns are never boxed into the counts. grouping_column can be a list, for
+# regions nested in others: the columns are then a MultiIndex sorted by the outer region, and rows with a blank inner
+# region (counts reported for the outer region as a whole) are kept with "" as their name.
+def aggregateJohnsData(path, grouping_column, columns, dates, replacement_columns=None):
+    grouping = grouping_column if isinstance(grouping_column, list) else [grouping_column]
+    df = pd.read_csv(path, usecols=[*grouping, *columns])
+    df[grouping] = df[grouping].fillna("")
+    keys = df[grouping]
+    if len(grouping) > 1 and not keys.duplicated().any():
+        # One row per region, as in the US county files: sorting the rows gives what summing would without the
+        # copies groupby makes of every group
+        regions, order = pd.MultiIndex.from_frame(keys).sort_values(return_indexer=True)
+        values = df[list(columns)].to_numpy()
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), 0, values)
+        values = compactCounts(values)[order]
+    else:
+        values = df.groupby(grouping_column)[list(columns)].sum()
+        regions = values.index if isinstance(values.index, pd.MultiIndex) else values.index.values
+        values = compactCounts(values.to_numpy())
+    df = pd.DataFrame(values.T, index=dates, columns=regions)
 
     if replacement_columns is not None:
-        df.rename(columns=replacement_columns,inplace=True)
+        df.rename(columns=replacement_columns, inplace=True)
 
     return df
+
+
+# Store counts in the smallest integer type that holds them. Missing values have been summed to 0 by this point,
+# so float arrays only come from blank cells and are converted too.
+def compactCounts(values):
+    if values.dtype.kind == "f":
+        if not np.isfinite(values).all():
+            return values
+        values = values.astype(np.int64)
+    if values.size == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+        return values.astype(np.int32)
+    return values.astype(np.int64)
@@ -0,0 +1,149 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import data_processing
+
+# Series the graphs show as transformations of the counts, computed once per snapshot for every region so callbacks
+# only need to slice them.
+
+# Log scale and new vs total graphs start where the total passes this
+logThreshold = 50
+
+# Counts the aligned view can start from: it plots each region against the days since its total reached the chosen one
+alignThresholds = [1, 10, 50, 100, 500, 1000]
+
+# Days in the window for the new vs total graph
+rollingDays = 7
+
+# PerCapita: counts per 10,000 population (NaN for regions without population data).
+# Start: position of the first row above logThreshold for each region (len(index) if it never gets there).
+# New7Day: new counts over the last rollingDays days.
+# Latest: for each region the date of the last total and the last total and new counts (NaN/NaT if there are none).
+# Alignment: position of the first row at or above each of alignThresholds (rows) for each region (columns).
+DerivedSeries = namedtuple("DerivedSeries", ["casesPerCapita", "casesStart", "casesNew7Day", "casesLatest",
+                                             "casesAlignment", "deathsPerCapita", "deathsStart", "deathsLatest",
+                                             "deathsAlignment"])
+
+
+def createDerivedSeries(cases, casesNew, deaths, deathsNew, population):
+    return DerivedSeries(
+        casesPerCapita=perCapita(cases, population),
+        casesStart=firstAbove(cases, logThreshold),
+        casesNew7Day=rollingSum(casesNew, pd.to_timedelta("%ddays" % rollingDays)),
+        casesLatest=latestValues(cases, casesNew),
+        casesAlignment=crossings(cases, alignThresholds),
+        deathsPerCapita=perCapita(deaths, population),
+        deathsStart=firstAbove(deaths, logThreshold),
+        deathsLatest=latestValues(deaths, deathsNew),
+        deathsAlignment=crossings(deaths, alignThresholds),
+    )
+
+
+# The series of one metric ("cases" or "deaths") for a selection of regions: total and new counts, label rows and the
+# derived series above (new7Day is None for deaths). Countries and states are taken from the snapshot's frames, which
+# are returned whole when nothing else is selected; US counties are worked out here, as only a few are ever shown.
+SelectedSeries = namedtuple("SelectedSeries", ["total", "new", "labels", "perCapita", "start", "new7Day", "latest",
+                                               "alignment"])
+
+
+def selectSeries(snapshot, metric, regions):
+    total = getattr(snapshot, metric)
+    derived = [getattr(snapshot.derived, metric + name, None) for name in ["PerCapita", "Start", "New7Day", "Latest",
+                                                                                "Alignment"]]
+    series = SelectedSeries(total, getattr(snapshot, metric + "New"), getattr(snapshot, metric + "Labels"), *derived)
+    regions = list(dict.fromkeys(regions))
+    counties = [region for region in regions if region not in total.columns]
+    if not counties:
+        return series
+
+    countyTotal = getattr(snapshot, metric + "Counties")[counties]
+    countyNew = countyTotal - countyTotal.shift()
+    county = SelectedSeries(
+        total=countyTotal,
+        new=countyNew,
+        labels=data_processing.createLabelIndex(countyTotal),
+        perCapita=perCapita(countyTotal, snapshot.population),
+        start=firstAbove(countyTotal, logThreshold),
+        new7Day=rollingSum(countyNew, pd.to_timedelta("%ddays" % rollingDays)) if series.new7Day is not None else None,
+        latest=latestValues(countyTotal, countyNew),
+        alignment=crossings(countyTotal, alignThresholds),
+    )
+    selected = [region for region in regions if region in total.columns]
+    return SelectedSeries(
+        total=pd.concat([series.total[selected], county.total], axis=1),
+        new=pd.concat([series.new[selected], county.new], axis=1),
+        labels=pd.concat([series.labels[selected], county.labels]),
+        perCapita=pd.concat([series.perCapita[selected], county.perCapita], axis=1),
+        start=pd.concat([series.start[selected], county.start]),
+        new7Day=pd.concat([series.new7Day[selected], county.new7Day], axis=1) if county.new7Day is not None else None,
+        latest=pd.concat([series.latest.loc[selected], county.latest]),
+        alignment=pd.concat([series.alignment[selected], county.alignment], axis=1),
+    )
+
+
+def perCapita(df, population):
+    regionPopulation = population.loc["Population"]
+    regionPopulation = regionPopulation[~regionPopulation.index.duplicated()]
+    regionPopulation = pd.to_numeric(regionPopulation.reindex(df.columns), errors="coerce")
+    # Counts may be stored as int32, which 10000 * counts overflows for large regions
+    return 10000 * df.astype(float) / regionPopulation.to_numpy()
+
+
+def firstAbove(df, threshold):
+    above = df.to_numpy() > threshold
+    start = above.argmax(axis=0)
+    start[~above.any(axis=0)] = len(df)
+    return pd.Series(start, index=df.columns)
+
+
+# Position of the first row at or above each of thresholds for each column (len(index) if it never gets there), as a
+# frame with a row per threshold. The running maximum of a column only goes up, so the rows before it reaches a
+# threshold are those where it is below, and every threshold is counted in one comparison over the whole frame.
+def crossings(df, thresholds):
+    values = df.to_numpy(dtype=float)
+    runningMax = np.maximum.accumulate(np.where(np.isnan(values), -np.inf, values), axis=0)
+    below = runningMax[np.newaxis, :, :] < np.asarray(thresholds, dtype=float)[:, np.newaxis, np.newaxis]
+    return pd.DataFrame(below.sum(axis=1), index=pd.Index(thresholds, name="threshold"), columns=df.columns)
+
+
+# Same as df.rolling(window).sum() for a time based window, from differences of the cumulative sum so every region
+# is done in one pass
+def rollingSum(df, window):
+    values = df.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    total = np.vstack([np.zeros((1, values.shape[1])), np.where(valid, values, 0).cumsum(axis=0)])
+    count = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64), valid.cumsum(axis=0)])
+
+    # Rows in the window ending at each row are those after windowStart - 1
+    windowStart = df.index.searchsorted(df.index - window, side="right")
+    end = np.arange(1, len(df) + 1)
+    sums = total[end] - total[windowStart]
+    sums[(count[end] - count[windowStart]) == 0] = np.nan
+    return pd.DataFrame(sums, index=df.index, columns=df.columns)
+
+
+# Same as df[region].dropna() followed by .index[-1] and .iloc[-1] for every region at once
+def latestValues(df, dfNew):
+    last = lastValid(df)
+    lastNew = lastValid(dfNew)
+    return pd.DataFrame({
+        "date": pd.DatetimeIndex(np.where(last >= 0, df.index.to_numpy()[last], np.datetime64("NaT"))),
+        "total": takeRows(df, last),
+        "new": takeRows(dfNew, lastNew),
+    }, index=df.columns)
+
+
+# Position of the last non NaN row in each column, -1 for columns that are all NaN
+def lastValid(df):
+    valid = df.notna().to_numpy()
+    last = len(df) - 1 - valid[::-1].argmax(axis=0)
+    last[~valid.any(axis=0)] = -1
+    return last
+
+
+def takeRows(df, rows):
+    values = df.to_numpy(dtype=float)[rows, np.arange(df.shape[1])]
+    values[rows < 0] = np.nan
+    return values
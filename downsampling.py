@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Reduce the number of points sent for large selections. Each trace gets an equal share of pointBudget, but never
+# fewer than plotWidth / 8 points or more than two per pixel of plotWidth.
+downsampleEnabled = os.environ.get("FIGURE_DOWNSAMPLE", "1") == "1"
+pointBudget = int(os.environ.get("FIGURE_POINT_BUDGET", 50000))
+plotWidth = int(os.environ.get("FIGURE_PLOT_WIDTH", 1200))
+
+# When zoomed in, points this far outside the visible range (as a fraction of its width) are sent too, so small pans
+# don't show an empty edge
+windowMargin = 0.25
+
+
+# Points each of traces should be reduced to, or None to send every point
+def pointsPerTrace(traces, width=None):
+    if not downsampleEnabled or traces == 0:
+        return None
+    width = plotWidth if width is None else width
+    return int(min(2 * width, max(width // 8, pointBudget // traces)))
+
+
+# Positions of the points kept by largest triangle three buckets downsampling of x, y to threshold points. The
+# first and last points are always kept, as are the positions in keep (used for points with a label). NaN points
+# are dropped first.
+def lttb(x, y, threshold, keep=()):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    keep = [k for k in keep if 0 <= k < len(y)]
+    if len(valid) <= threshold or threshold < 3:
+        return np.union1d(valid, keep).astype(np.int64)
+
+    # Relative to the first point so the running sums of dates in nanoseconds stay precise
+    x, y = x[valid] - x[valid[0]], y[valid]
+    n = len(x)
+    # The first and last points have buckets of their own, the rest are split evenly between the others
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # Sequential, as each bucket depends on the point chosen in the one before. Buckets hold a handful of points,
+    # so plain Python is faster here than numpy on tiny slices
+    sumX = np.concatenate([[0.0], x.cumsum()]).tolist()
+    sumY = np.concatenate([[0.0], y.cumsum()]).tolist()
+    bounds = np.append(edges, n).tolist()
+    xs, ys = x.tolist(), y.tolist()
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end, nextEnd = bounds[bucket], bounds[bucket + 1], bounds[bucket + 2]
+        nextX = (sumX[nextEnd] - sumX[end]) / (nextEnd - end)
+        nextY = (sumY[nextEnd] - sumY[end]) / (nextEnd - end)
+        ax, ay = xs[a], ys[a]
+        # Twice the area of the triangle from the last selected point, each candidate and the next bucket's average
+        best, bestArea = start, -1.0
+        for i in range(start, end):
+            area = abs((ax - nextX) * (ys[i] - ay) - (ax - xs[i]) * (nextY - ay))
+            if area > bestArea:
+                best, bestArea = i, area
+        a = best
+        selected[bucket + 1] = a
+
+    return np.union1d(valid[selected], keep).astype(np.int64)
+
+
+# The x range shown after a zoom or pan, from a graph's relayoutData. Returns [start, end] in axis units (date
+# strings for time axes, log10 values for log axes), "auto" when the axis has been reset, or None when relayoutData
+# says nothing about the x axis.
+def relayoutXRange(relayoutData):
+    if not relayoutData:
+        return None
+    if relayoutData.get("xaxis.autorange"):
+        return "auto"
+    if "xaxis.range" in relayoutData:
+        return list(relayoutData["xaxis.range"])
+    if "xaxis.range[0]" in relayoutData and "xaxis.range[1]" in relayoutData:
+        return [relayoutData["xaxis.range[0]"], relayoutData["xaxis.range[1]"]]
+    return None
+
+
+# Downsample a trace with pandas x and y to maxPoints. If xRange is given only points in it (plus a margin) are
+# kept. The point with the label is always kept.
+def downsampleTrace(trace, maxPoints, xRange=None, logX=False):
+    if xRange is not None:
+        trace = _takeTrace(trace, _window(trace["x"], xRange, logX))
+    if maxPoints is None or len(trace["y"]) <= maxPoints:
+        return trace
+
+    # The label is at or near the end of the text
+    text = trace.get("text", [])
+    label = next((i for i in range(len(text) - 1, -1, -1) if text[i]), None)
+    keep = lttb(_numeric(trace["x"]), trace["y"], maxPoints, keep=[label] if label is not None else ())
+    return _takeTrace(trace, keep)
+
+
+# Positions of x inside xRange widened by windowMargin
+def _window(x, xRange, logX):
+    x = _numeric(x)
+    if logX:
+        x = np.log10(np.where(x > 0, x, np.nan))
+        bounds = [float(v) for v in xRange]
+    elif isinstance(xRange[0], str):
+        bounds = _numeric(pd.to_datetime(list(xRange)))
+    else:
+        bounds = [float(v) for v in xRange]
+    start, end = sorted(bounds)
+    margin = (end - start) * windowMargin
+    return np.flatnonzero((x >= start - margin) & (x <= end + margin))
+
+
+def _numeric(x):
+    x = np.asarray(x)
+    if x.dtype.kind == "M":
+        return x.astype("datetime64[ns]").astype(np.int64)
+    return x.astype(float)
+
+
+def _takeTrace(trace, positions):
+    trace = dict(trace, x=_take(trace["x"], positions), y=_take(trace["y"], positions))
+    if "text" in trace:
+        text = trace["text"]
+        trace["text"] = [text[k] if k < len(text) else "" for k in positions]
+    return trace
+
+
+def _take(values, positions):
+    return values.iloc[positions] if hasattr(values, "iloc") else values[positions]
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from plotly.io.json import to_json_plotly
+
+# Maximum size of the cached figures, measured as JSON
+figureCacheBytes = int(float(os.environ.get("FIGURE_CACHE_MB", 64)) * 1024 * 1024)
+
+
+# Least recently used cache of finished figures. Figures are stored as plain JSON values so a hit is returned to
+# Dash without touching pandas again.
+class FigureCache:
+    def __init__(self, max_bytes=figureCacheBytes):
+        self.max_bytes = max_bytes
+        self._figures = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._figures.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._figures.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Store figure and return the JSON version of it to send
+    def put(self, key, figure):
+        encoded = to_json_plotly(figure)
+        figure = json.loads(encoded)
+        size = len(encoded)
+        if size > self.max_bytes:
+            return figure
+
+        with self._lock:
+            if key in self._figures:
+                self._bytes -= self._figures.pop(key)[1]
+            self._figures[key] = (figure, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._figures.popitem(last=False)[1][1]
+                self.evictions += 1
+        return figure
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        hit_rate=self.hits / requests if requests else 0.0,
+                        entries=len(self._figures), bytes=self._bytes)
@@ -0,0 +1,52 @@
+import base64
+import os
+
+import numpy as np
+
+# Send trace values as base64 typed arrays, and evenly spaced dates as a start and step, instead of JSON lists
+binaryFigures = os.environ.get("FIGURE_BINARY", "1") == "1"
+
+dayMilliseconds = 24 * 60 * 60 * 1000
+
+
+# Typed array spec understood by plotly.js for a numeric array. Integers that fit are sent as int32, everything
+# else as float64 (plotly.js has no 64 bit integers).
+def typedArray(values):
+    values = np.asarray(values)
+    if values.dtype.kind in "iub" and (values.size == 0 or (values.min() >= np.iinfo(np.int32).min and
+                                                              values.max() <= np.iinfo(np.int32).max)):
+        values, dtype = values.astype("<i4"), "i4"
+    else:
+        values, dtype = values.astype("<f8"), "f8"
+    return {"dtype": dtype, "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+
+
+# Encode the x and y values of each trace in figure. Figures with dates sent as numbers get an explicit date axis.
+def encodeFigure(figure):
+    if not binaryFigures:
+        return figure
+
+    dateAxis = False
+    data = []
+    for trace in figure["data"]:
+        trace = dict(trace)
+        x = np.asarray(trace["x"])
+        if x.dtype.kind == "M":
+            dateAxis = True
+            milliseconds = x.astype("datetime64[ms]").astype(np.int64)
+            steps = np.diff(milliseconds)
+            if len(x) > 0 and (len(steps) == 0 or (steps == steps[0]).all()):
+                del trace["x"]
+                trace["x0"] = str(x[0].astype("datetime64[ms]"))
+                trace["dx"] = int(steps[0]) if len(steps) else dayMilliseconds
+            else:
+                trace["x"] = typedArray(milliseconds)
+        elif x.dtype.kind in "iufb":
+            trace["x"] = typedArray(x)
+        trace["y"] = typedArray(trace["y"])
+        data.append(trace)
+
+    layout = dict(figure["layout"])
+    if dateAxis:
+        layout["xaxis"] = dict(layout["xaxis"], type="date")
+    return dict(figure, data=data, layout=layout)
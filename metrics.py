@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+# Time callbacks and data loading, send the times of each request in a Server-Timing header and export everything in
+# the Prometheus text format on /metrics
+metricsEnabled = os.environ.get("METRICS", "1") == "1"
+
+secondsBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+bytesBuckets = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+# Metrics and gauge functions in the order they are rendered
+registry = []
+
+
+# Counters and histograms keyed by their label values. Label values are given as keyword arguments.
+class Metric:
+    def __init__(self, name, help, type):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    # A copy of the values keyed by their label tuples: a number for counters, (buckets, count, sum) for histograms
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for key, value in sorted(self.values().items()):
+            lines.extend(self._lines(key, value))
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, "counter")
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _lines(self, key, value):
+        return ["%s%s %s" % (self.name, formatLabels(key), formatValue(value))]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=secondsBuckets):
+        super().__init__(name, help, "histogram")
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            buckets, count, total = self._values.get(key, ((0,) * len(self.buckets), 0, 0.0))
+            buckets = tuple(n + (value <= bound) for n, bound in zip(buckets, self.buckets))
+            self._values[key] = (buckets, count + 1, total + value)
+
+    def _lines(self, key, value):
+        buckets, count, total = value
+        bounds = [formatValue(bound) for bound in self.buckets] + ["+Inf"]
+        lines = ["%s_bucket%s %d" % (self.name, formatLabels(key + (("le", bound),)), n)
+                 for bound, n in zip(bounds, buckets + (count,))]
+        return lines + ["%s_sum%s %s" % (self.name, formatLabels(key), formatValue(total)),
+                        "%s_count%s %d" % (self.name, formatLabels(key), count)]
+
+
+# A value read when /metrics is requested. func returns a number, a dict of label tuples to numbers, or None.
+class Gauge:
+    def __init__(self, name, help, func, type="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        registry.append(self)
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)] + \
+               ["%s%s %s" % (self.name, formatLabels(key), formatValue(v)) for key, v in sorted(values.items())]
+
+
+def formatLabels(key):
+    if not key:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in key)
+
+
+def formatValue(value):
+    return "%d" % value if float(value).is_integer() else repr(float(value))
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+callbackSeconds = Histogram("dash_callback_duration_seconds", "Time to answer a Dash callback request")
+callbackBytes = Histogram("dash_callback_response_bytes", "Size of a Dash callback response before compression",
+                          bytesBuckets)
+callbackErrors = Counter("dash_callback_errors_total", "Dash callback requests that failed")
+stageSeconds = Histogram("data_stage_duration_seconds",
+                         "Time spent in each stage of loading data: fetch (download a source), parse (read and "
+                         "aggregate a source file), aggregate (combine the sources), derive (derived series)")
+sourceSeconds = Histogram("data_source_duration_seconds",
+                          "Time to read each data source (fetch and parse, or load its parsed copy), by source")
+refreshSeconds = Histogram("data_refresh_duration_seconds", "Time to load and publish a new data snapshot")
+refreshes = Counter("data_refreshes_total",
+                    "Data refreshes by result: loaded (the data was loaded) or coalesced (another thread or worker "
+                    "loaded it while this one waited for it, and its snapshot was used instead)")
+refreshWaitSeconds = Histogram("data_refresh_wait_seconds",
+                               "Time a refresh waited for a refresh already running in this or another worker")
+refreshErrors = Counter("data_refresh_errors_total", "Background data refreshes that failed")
+
+
+# Record the time taken by the block as a stage of loading data and, during a request, in its Server-Timing header
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observeStage(stage, time.perf_counter() - start)
+
+
+def observeStage(stage, seconds):
+    stageSeconds.observe(seconds, stage=stage)
+    if flask.has_request_context() and "serverTimings" in flask.g:
+        flask.g.serverTimings.append((stage, seconds))
+
+
+# Time Dash callback requests on server and add the /metrics route. callbackName maps a request's output to the name
+# of the callback answering it.
+def instrumentServer(server, callbackName):
+    if not metricsEnabled:
+        return
+
+    @server.before_request
+    def start_timing():
+        flask.g.serverTimings = []
+        flask.g.requestStart = time.perf_counter()
+
+    @server.after_request
+    def record_timing(response):
+        if "requestStart" not in flask.g:
+            return response
+        elapsed = time.perf_counter() - flask.g.requestStart
+        if flask.request.path.endswith("/_dash-update-component"):
+            body = flask.request.get_json(silent=True) or {}
+            callback = callbackName(body.get("output", ""))
+            callbackSeconds.observe(elapsed, callback=callback)
+            if response.status_code >= 500:
+                callbackErrors.inc(callback=callback)
+            elif not response.direct_passthrough:
+                callbackBytes.observe(len(response.get_data()), callback=callback)
+        timings = ["%s;dur=%.1f" % (stage, seconds * 1000) for stage, seconds in flask.g.serverTimings]
+        response.headers["Server-Timing"] = ", ".join(timings + ["total;dur=%.1f" % (elapsed * 1000)])
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        return flask.Response(render(), mimetype="text/plain; version=0.0.4")
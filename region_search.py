@@ -0,0 +1,72 @@
+import os
+from bisect import bisect_left
+
+# Load the region dropdown's options from the server as the user types, instead of sending every region up front
+regionSearch = os.environ.get("REGION_SEARCH", "0") == "1"
+# Most regions returned for one search
+searchLimit = int(os.environ.get("REGION_SEARCH_LIMIT", 50))
+# Most selected regions whose children are listed under them, so selecting every state doesn't list every county
+drillDownLimit = int(os.environ.get("REGION_DRILL_DOWN_LIMIT", 5))
+
+
+def createOptions(regions):
+    return [{"label": i, "value": i} for i in regions]
+
+
+# Dropdown options and a prefix index of a snapshot's regions. Built once per snapshot. Every region can be searched
+# for; the full options only list the regions in listed (all of them by default), and children maps a region to the
+# regions listed under it once it is selected (those not listed anyway).
+class RegionIndex:
+    def __init__(self, regions, listed=None, children=None):
+        self.regions = list(regions)
+        self.listed = self.regions if listed is None else list(listed)
+        listedSet = set(self.listed)
+        self.children = {}
+        for region, regionChildren in (children or {}).items():
+            unlisted = [child for child in regionChildren if child not in listedSet]
+            if unlisted:
+                self.children[region] = unlisted
+        self.options = createOptions(self.listed)
+
+        # Every word of a name is indexed, so "zea" finds "New Zealand" and "ala" finds "Alabama, USA"
+        keys = []
+        for position, region in enumerate(self.regions):
+            lower = region.lower()
+            for start in range(len(lower)):
+                if start == 0 or (not lower[start - 1].isalnum() and lower[start].isalnum()):
+                    keys.append((lower[start:], position))
+        keys.sort()
+        self._keys = [key for key, position in keys]
+        self._positions = [position for key, position in keys]
+
+    # What the options for selected list beyond the listed regions, as [expanded, extra]: the first drillDownLimit
+    # selected regions with children, whose children are listed after them, and the other selected regions that
+    # wouldn't be listed (the dropdown drops values that aren't among its options). The options only change with it.
+    def drillDown(self, selected):
+        selected = list(selected or [])
+        expanded = [region for region in selected if region in self.children][:drillDownLimit]
+        shown = set(self.listed).union(*(self.children[region] for region in expanded))
+        return [expanded, [region for region in selected if region not in shown]]
+
+    # Options listing what drillDown gives for selected. None if that is just the full options.
+    def drillDownOptions(self, selected):
+        expanded, extra = self.drillDown(selected)
+        if not expanded and not extra:
+            return None
+        regions = []
+        for region in self.listed:
+            regions.append(region)
+            if region in expanded:
+                regions.extend(self.children[region])
+        return createOptions(regions + extra)
+
+    # Regions with a word starting with text, in dropdown order
+    def search(self, text, limit=None):
+        limit = searchLimit if limit is None else limit
+        text = text.strip().lower()
+        found = set()
+        for i in range(bisect_left(self._keys, text), len(self._keys)):
+            if not self._keys[i].startswith(text) or len(found) >= limit:
+                break
+            found.add(self._positions[i])
+        return [self.regions[position] for position in sorted(found)]
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# Hierarchy of the regions the app can show: countries, then US states, then US counties. Regions are numbered by
+# their position in the table, in that order, and each region's children are numbered consecutively, so the totals
+# of a parent are the sum of a contiguous range of its children's columns.
+levels = ["country", "state", "county"]
+
+
+# Table of regions indexed by name, with columns id, level and parent (the parent's id, -1 for countries).
+# states are state names without the ", USA" suffix; counties is a (state, county name) MultiIndex.
+def createRegionTable(countries, states, counties, stateParent="USA"):
+    names = list(countries) + [stateName(state) for state in states] + list(countyNames(counties))
+    countryIds = {name: i for i, name in enumerate(countries)}
+    stateIds = {state: len(countries) + i for i, state in enumerate(states)}
+    parents = [-1] * len(countries) + \
+              [countryIds.get(stateParent, -1)] * len(states) + \
+              [stateIds.get(state, -1) for state in counties.get_level_values(0)]
+    levelCodes = [0] * len(countries) + [1] * len(states) + [2] * len(counties)
+    return pd.DataFrame(dict(id=np.arange(len(names)),
+                             level=pd.Categorical.from_codes(levelCodes, levels),
+                             parent=np.array(parents, dtype=np.int64)), index=pd.Index(names, name="region"))
+
+
+def stateName(state):
+    return state + ", USA"
+
+
+def countyNames(counties):
+    return pd.Index(["%s, %s, USA" % (county, state) for state, county in counties])
+
+
+# Sum the columns of df, which have a (parent, child) MultiIndex sorted by parent, into one column per parent. One
+# pass over the values: each parent's columns are contiguous, so this is a sum over each range.
+def rollup(df):
+    parents = df.columns.get_level_values(0)
+    starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+    values = df.to_numpy()
+    if values.dtype.kind in "iub":
+        # Parents can exceed the children's integer type
+        values = values.astype(np.int64)
+    return pd.DataFrame(np.add.reduceat(values, starts, axis=1) if len(starts) else values[:, :0],
+                        index=df.index, columns=parents[starts])
+
+
+# Columns of df that are counties (rows with a county name, as opposed to a state reported as a whole), renamed to
+# their region names
+def countyColumns(df):
+    counties = df.columns[df.columns.get_level_values(1) != ""]
+    return df[counties].set_axis(countyNames(counties), axis=1)
+
+
+# Names of the children of each region that has any, in table order
+def childNames(table):
+    names = pd.Series(table.index, index=table["id"].to_numpy())
+    children = table[table["parent"] >= 0]
+    return {names[parent]: list(group.index) for parent, group in children.groupby("parent", sort=False)}
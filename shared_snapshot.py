@@ -0,0 +1,122 @@
+import json
+import os
+import pickle
+import shutil
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where refreshes are only coordinated between threads of one worker
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+import data_fetch
+
+# Processed snapshots are written here once and memory mapped read only by every worker, so the frames are held in
+# memory once however many workers there are, and a new worker can start without downloading anything
+sharedSnapshots = os.environ.get("SHARED_SNAPSHOT", "1") == "1"
+snapshotDir = os.environ.get("SNAPSHOT_DIR", os.path.join(data_fetch.cacheDir, "snapshot"))
+
+
+# A directory holding one subdirectory per snapshot version and a "current" file naming the latest one:
+#   current            {"version": ..., "format": ..., "loadedAt": ...}
+#   <version>-<format>/meta.pkl regions and dates of each mapped frame, and the small values (series, population)
+#   <version>-<format>/<name>.npy  numeric frames as (dates x regions) arrays in column major order, so each region's
+#                                  values are contiguous and pandas uses the mapped array without copying
+# format names how the fields were built (see data_manager.snapshotFormat). The version only changes with the data, so
+# snapshots written in another format are ignored, as if there were none, rather than mapped.
+class SharedSnapshot:
+    def __init__(self, directory=snapshotDir, format=""):
+        self.directory = directory
+        self.format = format
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def _versionName(self, version):
+        return "%s-%s" % (version, self.format) if self.format else version
+
+    # The latest version written by any worker, or None if there isn't one
+    def current(self):
+        try:
+            with open(self._path("current")) as f:
+                current = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return current if current.get("format", "") == self.format else None
+
+    # Hold an exclusive lock, shared by every worker using this directory, while the block runs. The lock is released
+    # if the worker dies holding it.
+    @contextmanager
+    def lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("refresh.lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Write fields (a dict of frames and other values) as version, then point "current" at it. The files of older
+    # versions are removed; workers that still map them keep their pages until they remap.
+    def write(self, version, loadedAt, fields):
+        versionDir = self._path(self._versionName(version))
+        if self._names(version) != set(fields):
+            tmpDir = self._path("%s.%d.%d.tmp" % (self._versionName(version), os.getpid(), threading.get_ident()))
+            os.makedirs(tmpDir)
+            meta = dict(frames={}, values={})
+            for name, value in fields.items():
+                if isinstance(value, pd.DataFrame) and len(value.columns) > 0 and \
+                        all(dtype.kind in "iufb" for dtype in value.dtypes):
+                    np.save(os.path.join(tmpDir, name + ".npy"), np.asfortranarray(value.to_numpy()))
+                    meta["frames"][name] = (value.index, value.columns)
+                else:
+                    meta["values"][name] = value
+            with open(os.path.join(tmpDir, "meta.pkl"), "wb") as f:
+                pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if self._names(version) is not None:
+                # Written by an older version of the app with different fields
+                shutil.rmtree(versionDir, ignore_errors=True)
+            try:
+                os.rename(tmpDir, versionDir)
+            except OSError:
+                # Another worker wrote the same version first
+                shutil.rmtree(tmpDir, ignore_errors=True)
+
+        tmp = self._path("current.%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+        with open(tmp, "w") as f:
+            json.dump(dict(version=version, format=self.format, loadedAt=loadedAt), f)
+        os.replace(tmp, self._path("current"))
+        self._removeOld(self._versionName(version))
+
+    # Map version read only. Returns the fields given to write, with frames backed by the files.
+    def load(self, version):
+        versionDir = self._path(self._versionName(version))
+        with open(os.path.join(versionDir, "meta.pkl"), "rb") as f:
+            meta = pickle.load(f)
+        fields = dict(meta["values"])
+        for name, (index, columns) in meta["frames"].items():
+            values = np.load(os.path.join(versionDir, name + ".npy"), mmap_mode="r")
+            fields[name] = pd.DataFrame(values, index=index, columns=columns, copy=False)
+        return fields
+
+    # Names of the fields stored for version, or None if it hasn't been written
+    def _names(self, version):
+        try:
+            with open(self._path(self._versionName(version), "meta.pkl"), "rb") as f:
+                meta = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return set(meta["frames"]) | set(meta["values"])
+
+    def _removeOld(self, version):
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name != version and os.path.isdir(path) and not name.endswith(".tmp"):
+                shutil.rmtree(path, ignore_errors=True)